@@ -1,9 +1,781 @@
+import csv
+import json
+import os
+import sqlite3
+import time
 import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import NamedTuple
 import bw2data as bd
 import numpy as np
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
-from functools import lru_cache
+from bw2data.backends import Activity, ActivityDataset, ExchangeDataset, sqlite3_lci_db
+from bw2data.backends.utils import dict_as_activitydataset, dict_as_exchangedataset
+from bw2data.search import IndexManager
+from bw2data.search.indices import MODELS as SEARCH_MODELS
+from fuzzywuzzy import utils as fuzz_utils
+
+try:
+    # optional, C-accelerated scoring of many queries at once
+    from rapidfuzz import fuzz as rf_fuzz
+    from rapidfuzz import process as rf_process
+except ImportError:
+    rf_process = None
+
+try:
+    # optional, the C implementation of the same ratio, also what fuzzywuzzy uses when it's installed
+    from Levenshtein import ratio as lev_ratio
+except ImportError:
+    lev_ratio = None
+
+try:
+    # optional, to read correspondence tables from Excel files
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# number of queries scored against a corpus at once, bounds the size of the score matrix
+SCORE_CHUNK_SIZE = 256
+# number of candidates kept by the n-gram prefilter before full scoring
+PREFILTER_LIMIT = 300
+# maximum number of codes in a single "IN" clause, sqlite limits the number of query variables
+QUERY_CHUNK_SIZE = 500
+# fields of old nodes kept in memory, everything needed to match activities and biosphere flows
+NODE_FIELDS = (
+    "name",
+    "location",
+    "unit",
+    "reference product",
+    "categories",
+    "CAS number",
+)
+# rows per insert statement, and number of buffered rows that triggers a flush of the bulk writer
+BULK_INSERT_SIZE = 250
+BULK_FLUSH_SIZE = 20000
+# number of queued entries that triggers a write of the persistent cache
+PERSISTENT_FLUSH_SIZE = 500
+# seconds between two checkpoints while activities are being created
+CHECKPOINT_INTERVAL = 300
+# biosphere flows renamed between ecoinvent versions, old name -> new name
+BIOSPHERE_SYNONYMS = {
+    "Particulates, > 10 um": "Particulate matter, > 10 um",
+    "Particulates, < 2.5 um": "Particulate matter, < 2.5 um",
+    "Particulates, > 2.5 um, and < 10um": "Particulate matter, > 2.5 um and < 10um",
+}
+
+
+def _read_table(path: str, sheet_name: str = None) -> list[dict]:
+    """
+    Reads the rows of a .csv, .xlsx or .json file as dictionaries keyed on the column names.
+    A json file can also hold a single {old: new} dictionary, returned as rows with "old" and "new" columns.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            return list(csv.DictReader(f))
+    if extension == ".json":
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            return [{"old": old, "new": new} for old, new in data.items()]
+        return data
+    if extension in (".xlsx", ".xlsm"):
+        if openpyxl is None:
+            raise ImportError(
+                f"Reading '{path}' requires openpyxl: pip install openpyxl"
+            )
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        sheet = workbook[sheet_name] if sheet_name else workbook.active
+        rows = sheet.iter_rows(values_only=True)
+        header = [str(cell) if cell is not None else "" for cell in next(rows, ())]
+        return [dict(zip(header, row)) for row in rows]
+    raise ValueError(f"Unsupported correspondence file format '{extension}': {path}")
+
+
+def _sort_tokens(text: str) -> str:
+    """
+    Preprocesses a string the way fuzz.token_sort_ratio does, so it only has to be done once per choice.
+    """
+    return " ".join(sorted(fuzz_utils.full_process(text, force_ascii=True).split()))
+
+
+def _normalize(text: str) -> str:
+    """
+    Normalizes a name for the normalized match index: lower case, brackets as separate tokens, no commas,
+    single spaces and sorted tokens. "iron (III) chloride, in solution" and "iron(III) chloride in solution"
+    give the same string.
+    """
+    if text is None:
+        return None
+    text = text.lower().replace("[", "(").replace("]", ")").replace(",", " ")
+    text = text.replace("(", " ( ").replace(")", " ) ")
+    return " ".join(sorted(text.split()))
+
+
+def _ngrams(sorted_text: str) -> set[str]:
+    """
+    Returns the tokens and character trigrams of a string processed by _sort_tokens.
+    Tokens are prefixed with "#", which can't appear in processed strings, so they don't collide with trigrams.
+    """
+    grams = set()
+    for token in sorted_text.split():
+        grams.add(f"#{token}")
+        padded = f" {token} "
+        grams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _indel_ratio(s1: str, s2: str) -> float:
+    """
+    The normalized Indel similarity of two strings between 0 and 100, the ratio computed by rapidfuzz.fuzz.ratio,
+    python-Levenshtein and fuzzywuzzy with python-Levenshtein. fuzzywuzzy without it uses difflib instead,
+    which gives slightly different scores, so it isn't used here.
+    """
+    if lev_ratio is not None:
+        return 100 * lev_ratio(s1, s2)
+    length = len(s1) + len(s2)
+    if not length:
+        return 100.0
+    # 1 - indel distance / total length, with indel distance = total length - 2 * longest common subsequence
+    previous = [0] * (len(s2) + 1)
+    for c1 in s1:
+        current = [0]
+        for j, c2 in enumerate(s2):
+            current.append(
+                previous[j] + 1 if c1 == c2 else max(previous[j + 1], current[j])
+            )
+        previous = current
+    return 100 * 2 * previous[-1] / length
+
+
+def _score_matrix(queries: list[str], choices: list[str]) -> np.ndarray:
+    """
+    Scores every query against every choice with the token sort ratio.
+    Uses rapidfuzz if it is installed and falls back to _indel_ratio otherwise, both give the same scores.
+
+    Parameters:
+    - queries (list of str): The N queries, already passed through _sort_tokens.
+    - choices (list of str): The M choices, already passed through _sort_tokens.
+
+    Returns:
+    - np.ndarray: An N x M matrix of scores between 0 and 100.
+    """
+    if rf_process is not None:
+        # the strings are already processed and sorted, so a plain ratio equals token_sort_ratio
+        scores = rf_process.cdist(
+            queries, choices, scorer=rf_fuzz.ratio, dtype=np.float32, workers=-1
+        )
+        # fuzzywuzzy rounds to integers, keep the same scale for the score cutoff
+        return np.rint(scores)
+    scores = np.zeros((len(queries), len(choices)), dtype=np.float32)
+    for i, query in enumerate(queries):
+        scores[i] = [_indel_ratio(query, choice) for choice in choices]
+    return np.rint(scores)
+
+
+def _strongly_connected_components(nodes: list, successors) -> list[list]:
+    """
+    Tarjan's algorithm, without recursion so long supply chains don't hit the recursion limit.
+    Only edges between the given nodes are followed.
+
+    Parameters:
+    - nodes (list): The nodes of the graph.
+    - successors (callable): Returns the nodes a node depends on.
+
+    Returns:
+    - list of lists: The strongly connected components, each one after the components it depends on.
+    """
+    members = set(nodes)
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors(root)))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in members:
+                    continue
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors(child))))
+                    break
+                if child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+class _FuzzyCorpus:
+    """
+    The formatted choice strings of a database used for fuzzy matching,
+    with a parallel list holding the key of the activity each choice was made from.
+    Built once per (project, database, mode), see ActivityProjectMigrator._get_corpus.
+    """
+
+    def __init__(
+        self,
+        choices: list[str],
+        keys: list[tuple],
+        units: list[str] = None,
+        locations: list[str] = None,
+    ) -> None:
+        self.choices = choices
+        self.keys = keys
+        self.sorted_choices = [_sort_tokens(choice) for choice in choices]
+        # parallel to choices, used for blocking, see block_candidates
+        self.units = units if units is not None else [None] * len(choices)
+        self.locations = locations if locations is not None else [None] * len(choices)
+        self._unit_buckets = None
+        self._location_buckets = None
+        self._blocks = {}
+        # n-gram -> indices of the choices containing it, built on first use, see prefilter
+        self._postings = None
+        self._gram_counts = None
+        # the same for choices added after the postings were built, see add
+        self._added_postings = {}
+
+    @classmethod
+    def from_database(cls, database_name: str, biosphere: bool) -> "_FuzzyCorpus":
+        """
+        Builds the corpus from a database of the current project.
+
+        Parameters:
+        - database_name (str): Name of the database.
+        - biosphere (bool): If True, choices are "name categories", otherwise "name location reference product".
+        """
+        choices, keys, units, locations = [], [], [], []
+        for entry in bd.Database(database_name):
+            choices.append(cls.choice(entry, biosphere))
+            keys.append(entry.key)
+            units.append(entry.get("unit"))
+            locations.append(entry.get("location"))
+        return cls(choices, keys, units, locations)
+
+    @staticmethod
+    def choice(data, biosphere: bool) -> str:
+        """
+        Formats the choice string of an activity or flow: "name categories" for the biosphere,
+        "name location reference product" otherwise.
+        """
+        if biosphere:
+            return f"{data['name']} {data['categories']}"
+        return f"{data['name']} {data['location']} {data['reference product']}"
+
+    def add(
+        self, choice: str, key: tuple, unit: str = None, location: str = None
+    ) -> None:
+        """
+        Adds a choice to the corpus, e.g. for an activity that was just reserved in the database.
+        The buckets and n-gram postings that are already built are extended, so nothing is rebuilt.
+
+        Parameters:
+        - choice (str): The choice string, formatted like the others, see from_database.
+        - key (tuple): The key of the activity the choice was made from.
+        - unit (str): Its unit, used for blocking.
+        - location (str): Its location, used for blocking.
+        """
+        i = len(self.choices)
+        self.choices.append(choice)
+        self.keys.append(key)
+        self.sorted_choices.append(_sort_tokens(choice))
+        self.units.append(unit)
+        self.locations.append(location)
+        if self._unit_buckets is not None:
+            self._unit_buckets.setdefault(unit, []).append(i)
+            self._location_buckets.setdefault((unit, location), []).append(i)
+            # cached blocks of this unit are missing the new choice
+            self._blocks = {
+                block: candidates
+                for block, candidates in self._blocks.items()
+                if block[0] != unit
+            }
+        if self._postings is not None:
+            grams = _ngrams(self.sorted_choices[i])
+            self._gram_counts = np.append(self._gram_counts, np.float32(len(grams)))
+            for gram in grams:
+                self._added_postings.setdefault(gram, []).append(i)
+
+    def block_candidates(self, unit: str, locations: tuple = None) -> np.ndarray:
+        """
+        Returns the indices of the choices with the given unit and, if given, one of the given locations.
+        The buckets are built once per corpus, the candidates of a block are cached.
+
+        Parameters:
+        - unit (str): The unit the candidates must have.
+        - locations (tuple): The locations the candidates may have, None to allow any location.
+
+        Returns:
+        - np.ndarray: The sorted indices of the candidates.
+        """
+        if (unit, locations) not in self._blocks:
+            if self._unit_buckets is None:
+                self._unit_buckets, self._location_buckets = {}, {}
+                for i, (choice_unit, location) in enumerate(
+                    zip(self.units, self.locations)
+                ):
+                    self._unit_buckets.setdefault(choice_unit, []).append(i)
+                    self._location_buckets.setdefault(
+                        (choice_unit, location), []
+                    ).append(i)
+            if locations is None:
+                candidates = self._unit_buckets.get(unit, [])
+            else:
+                candidates = sorted(
+                    i
+                    for location in set(locations)
+                    for i in self._location_buckets.get((unit, location), [])
+                )
+            self._blocks[(unit, locations)] = np.asarray(candidates, dtype=np.int64)
+        return self._blocks[(unit, locations)]
+
+    def prefilter(
+        self, sorted_query: str, limit: int, candidates: np.ndarray = None
+    ) -> np.ndarray:
+        """
+        Uses the inverted n-gram index to pick the choices sharing the most tokens and trigrams with a query.
+        Overlap is measured with the dice coefficient so long choices aren't favoured.
+
+        Parameters:
+        - sorted_query (str): The query, processed with _sort_tokens.
+        - limit (int): The maximum number of candidates returned.
+        - candidates (np.ndarray): Optional indices the result is restricted to, e.g. from block_candidates.
+
+        Returns:
+        - np.ndarray: The sorted indices of the best candidates, choices without any overlap are left out.
+        """
+        if self._postings is None:
+            postings = {}
+            gram_counts = np.zeros(len(self.sorted_choices), dtype=np.float32)
+            for i, choice in enumerate(self.sorted_choices):
+                grams = _ngrams(choice)
+                gram_counts[i] = len(grams)
+                for gram in grams:
+                    postings.setdefault(gram, []).append(i)
+            self._postings = {
+                gram: np.asarray(indices, dtype=np.int64)
+                for gram, indices in postings.items()
+            }
+            self._gram_counts = gram_counts
+        grams = _ngrams(sorted_query)
+        hits = [self._postings[gram] for gram in grams if gram in self._postings]
+        hits.extend(
+            np.asarray(self._added_postings[gram], dtype=np.int64)
+            for gram in grams
+            if gram in self._added_postings
+        )
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        overlap = np.bincount(np.concatenate(hits), minlength=len(self.sorted_choices))
+        similarity = 2 * overlap / (len(grams) + self._gram_counts)
+        if candidates is None:
+            candidates = np.arange(len(self.sorted_choices))
+        similarity = similarity[candidates]
+        if len(candidates) > limit:
+            best = np.argpartition(-similarity, limit - 1)[:limit]
+        else:
+            best = np.arange(len(candidates))
+        best = best[similarity[best] > 0]
+        # sorted so ties are scored in database order
+        return np.sort(candidates[best])
+
+    def search(
+        self,
+        queries: list[str],
+        score_cutoff: float = 70,
+        limit: int = 5,
+        blocks: list[tuple] = None,
+        prefilter_limit: int = None,
+    ) -> list[list[tuple]]:
+        """
+        Scores a batch of queries against the corpus and returns the best matches of each query.
+
+        Parameters:
+        - queries (list of str): The queries to be matched.
+        - score_cutoff (float): The minimum score for a match to be considered.
+        - limit (int): The maximum number of matches returned per query.
+        - blocks (list of tuples): Optional, for each query a (unit, locations) tuple passed to block_candidates
+            or None to score the query against the whole corpus.
+        - prefilter_limit (int): If set, only this many candidates per query, picked by n-gram overlap
+            (see prefilter), are fully scored. Has no effect if there are fewer candidates than that.
+
+        Returns:
+        - list of lists: For each query, a list of (key, score) tuples sorted by descending score.
+        """
+        results = [None] * len(queries)
+        sorted_queries = [_sort_tokens(query) for query in queries]
+        # queries sharing a block are scored together against the same candidates
+        groups = {}
+        for position, block in enumerate(blocks or [None] * len(queries)):
+            if block is not None and block[1] is not None:
+                block = (block[0], tuple(block[1]))
+            groups.setdefault(block, []).append(position)
+        for block, positions in groups.items():
+            candidates = None if block is None else self.block_candidates(*block)
+            size = len(self.choices) if candidates is None else len(candidates)
+            if prefilter_limit is None or size <= prefilter_limit:
+                matches = self._search_candidates(
+                    [sorted_queries[position] for position in positions],
+                    candidates,
+                    score_cutoff,
+                    limit,
+                )
+            else:
+                # every query gets its own candidates, so they are scored one by one
+                matches = [
+                    self._search_candidates(
+                        [sorted_queries[position]],
+                        self.prefilter(
+                            sorted_queries[position], prefilter_limit, candidates
+                        ),
+                        score_cutoff,
+                        limit,
+                    )[0]
+                    for position in positions
+                ]
+            for position, query_matches in zip(positions, matches):
+                results[position] = query_matches
+        return results
+
+    def _search_candidates(
+        self,
+        sorted_queries: list[str],
+        candidates: np.ndarray,
+        score_cutoff: float,
+        limit: int,
+    ) -> list[list[tuple]]:
+        """
+        Scores preprocessed queries against a subset of the corpus, or the whole corpus if candidates is None.
+        """
+        if candidates is None:
+            choices = self.sorted_choices
+        else:
+            choices = [self.sorted_choices[i] for i in candidates]
+        results = []
+        for start in range(0, len(sorted_queries), SCORE_CHUNK_SIZE):
+            chunk = sorted_queries[start : start + SCORE_CHUNK_SIZE]
+            if not choices:
+                results.extend([] for _ in chunk)
+                continue
+            for row in _score_matrix(chunk, choices):
+                above = np.flatnonzero(row >= score_cutoff)
+                # stable sort so ties keep the database order, like process.extract does
+                best = above[np.argsort(-row[above], kind="stable")[:limit]]
+                results.append(
+                    [
+                        (
+                            self.keys[i if candidates is None else candidates[i]],
+                            float(row[i]),
+                        )
+                        for i in best
+                    ]
+                )
+        return results
+
+
+class _BulkWriter:
+    """
+    Buffers new activities and exchanges and writes them to the current project in one transaction,
+    instead of one transaction (plus search index and metadata updates) per saved row.
+    Activities need their database and code set when added, so their keys are final before the flush.
+    """
+
+    def __init__(self) -> None:
+        self.activities = []
+        self.exchanges = []
+
+    def __len__(self) -> int:
+        return len(self.activities) + len(self.exchanges)
+
+    def add_activity(self, data: dict) -> tuple:
+        """
+        Buffers an activity, data must contain "database" and "code". Returns the key of the activity.
+        """
+        self.activities.append(data)
+        return (data["database"], data["code"])
+
+    def add_exchange(self, data: dict) -> None:
+        """
+        Buffers an exchange, data must contain "input", "output" and "type" with keys as inputs and outputs.
+        """
+        self.exchanges.append(data)
+
+    def flush(self) -> None:
+        """
+        Writes everything buffered to the current project in a single transaction,
+        then updates the database metadata, geomapping and search index once per database.
+        """
+        if not len(self):
+            return
+        activity_rows = []
+        for data in self.activities:
+            try:
+                activity_rows.append(
+                    dict_as_activitydataset(data, add_snowflake_id=True)
+                )
+            except TypeError:
+                # bw2data versions without snowflake ids let sqlite assign the id
+                activity_rows.append(dict_as_activitydataset(data))
+        exchange_rows = [dict_as_exchangedataset(data) for data in self.exchanges]
+        with sqlite3_lci_db.atomic():
+            for start in range(0, len(activity_rows), BULK_INSERT_SIZE):
+                ActivityDataset.insert_many(
+                    activity_rows[start : start + BULK_INSERT_SIZE]
+                ).execute()
+            for start in range(0, len(exchange_rows), BULK_INSERT_SIZE):
+                ExchangeDataset.insert_many(
+                    exchange_rows[start : start + BULK_INSERT_SIZE]
+                ).execute()
+
+        touched = {data["database"] for data in self.activities}
+        touched.update(data["output"][0] for data in self.exchanges)
+        for database in touched:
+            bd.databases.set_dirty(database)
+        locations = {
+            data["location"] for data in self.activities if data.get("location")
+        }
+        bd.geomapping.add(
+            [location for location in locations if location not in bd.geomapping]
+        )
+        for database in {data["database"] for data in self.activities}:
+            if bd.databases[database].get("searchable", True):
+                IndexManager(bd.Database(database).filename).add_datasets(
+                    [data for data in self.activities if data["database"] == database]
+                )
+        self.activities, self.exchanges = [], []
+
+
+class Resolution(NamedTuple):
+    """
+    The canonical result of migrating an old activity, as stored in ActivityProjectMigrator.cache.
+    """
+
+    new_key: tuple  # None if nothing was found
+    kind: str  # "correspondence", "exact", "normalized", "location", "fuzzy", "created" or "not_found"
+    # the fuzzy matching score, for "not_found" the cutoff fuzzy matching was tried with (None if it wasn't),
+    # None for other kinds
+    score: float
+
+
+class MigrationCache:
+    """
+    In-memory cache of resolutions keyed on old activity keys, with an optional maximum size.
+    When full, the least recently used entry is evicted. Hits, misses and evictions are counted
+    so the size can be tuned for long running migrations.
+    """
+
+    def __init__(self, max_size: int = None) -> None:
+        """
+        Parameters:
+        - max_size (int): Maximum number of entries, None for no limit.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, old_key: tuple, default=None):
+        """
+        Returns the resolution of old_key, or default if it isn't cached. Counts as a hit or a miss.
+        """
+        if old_key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(old_key)
+            return self._entries[old_key]
+        self.misses += 1
+        return default
+
+    def __getitem__(self, old_key: tuple) -> Resolution:
+        return self._entries[old_key]
+
+    def __setitem__(self, old_key: tuple, resolution: Resolution) -> None:
+        self._entries[old_key] = resolution
+        self._entries.move_to_end(old_key)
+        if self.max_size is not None:
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, old_key: tuple) -> bool:
+        return old_key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def items(self):
+        return self._entries.items()
+
+    def pop(self, old_key: tuple, default=None):
+        """
+        Removes old_key and returns its resolution, or default if it isn't cached.
+        """
+        return self._entries.pop(old_key, default)
+
+    def clear(self) -> None:
+        """
+        Drops all entries, the counters are kept.
+        """
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the size and the hit, miss and eviction counters of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+class _PersistentCache:
+    """
+    Migration results stored in a local sqlite file, so they survive the migrator instance.
+    Entries are scoped to (old project, old db, new project, new db) and map an old key to the resolved
+    new key, how it was found and the fuzzy score. All entries of a scope are dropped when the modification
+    timestamp of either database differs from the one recorded with them.
+    """
+
+    def __init__(self, path: str, scope: tuple) -> None:
+        self.path = path
+        self.scope = scope
+        # old key (json) -> row, entries not written yet
+        self.pending = {}
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS resolutions (old_project TEXT, old_db TEXT, new_project TEXT, "
+                "new_db TEXT, old_key TEXT, new_key TEXT, kind TEXT, score REAL, "
+                "PRIMARY KEY (old_project, old_db, new_project, new_db, old_key))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS stamps (old_project TEXT, old_db TEXT, new_project TEXT, "
+                "new_db TEXT, old_modified TEXT, new_modified TEXT, "
+                "PRIMARY KEY (old_project, old_db, new_project, new_db))"
+            )
+
+    def validate(self, old_modified: str, new_modified: str) -> None:
+        """
+        Drops all entries of the scope if either database was modified since they were stored.
+        The entries themselves stay in the file and are read one at a time, see get.
+
+        Parameters:
+        - old_modified (str): The current modification timestamp of the old database.
+        - new_modified (str): The current modification timestamp of the new database.
+        """
+        where = "old_project = ? AND old_db = ? AND new_project = ? AND new_db = ?"
+        stamps = self.connection.execute(
+            f"SELECT old_modified, new_modified FROM stamps WHERE {where}", self.scope
+        ).fetchone()
+        if stamps != (old_modified, new_modified):
+            with self.connection:
+                self.connection.execute(
+                    f"DELETE FROM resolutions WHERE {where}", self.scope
+                )
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO stamps VALUES (?, ?, ?, ?, ?, ?)",
+                    (*self.scope, old_modified, new_modified),
+                )
+
+    def get(self, old_key: tuple):
+        """
+        Returns the stored (or queued) Resolution of old_key, None if there is none.
+        This is a primary key lookup, so nothing but the queued entries is held in memory.
+        """
+        dumped = json.dumps(old_key)
+        row = self.pending.get(dumped)
+        if row is not None:
+            new_key, kind, score = row[5:]
+        else:
+            row = self.connection.execute(
+                "SELECT new_key, kind, score FROM resolutions WHERE old_project = ? AND old_db = ? "
+                "AND new_project = ? AND new_db = ? AND old_key = ?",
+                (*self.scope, dumped),
+            ).fetchone()
+            if row is None:
+                return None
+            new_key, kind, score = row
+        return Resolution(tuple(json.loads(new_key)), kind, score)
+
+    def add(self, old_key: tuple, resolution: Resolution) -> None:
+        """
+        Queues an entry, it's written on the next flush.
+        """
+        self.pending[json.dumps(old_key)] = (
+            *self.scope,
+            json.dumps(old_key),
+            json.dumps(resolution.new_key),
+            resolution.kind,
+            resolution.score,
+        )
+        if len(self.pending) >= PERSISTENT_FLUSH_SIZE:
+            self.flush()
+
+    def discard(self, new_keys: set) -> None:
+        """
+        Drops the stored and queued entries resolved to any of new_keys, used when those activities were deleted.
+        """
+        dumped = {json.dumps(new_key) for new_key in new_keys}
+        self.pending = {
+            old_key: entry
+            for old_key, entry in self.pending.items()
+            if entry[5] not in dumped
+        }
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM resolutions WHERE old_project = ? AND old_db = ? AND new_project = ? "
+                "AND new_db = ? AND new_key = ?",
+                [(*self.scope, new_key) for new_key in dumped],
+            )
+
+    def flush(self, new_modified: str = None) -> None:
+        """
+        Writes the queued entries in one transaction.
+
+        Parameters:
+        - new_modified (str): If given, the recorded timestamp of the new database is updated,
+            used after the migrator wrote to the new database itself so its own writes don't invalidate the cache.
+        """
+        with self.connection:
+            if self.pending:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO resolutions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    list(self.pending.values()),
+                )
+            if new_modified is not None:
+                self.connection.execute(
+                    "UPDATE stamps SET new_modified = ? WHERE old_project = ? AND old_db = ? "
+                    "AND new_project = ? AND new_db = ?",
+                    (new_modified, *self.scope),
+                )
+        self.pending = {}
 
 
 class ActivityProjectMigrator:
@@ -20,6 +792,16 @@ class ActivityProjectMigrator:
         old_project_name: str,
         new_db_name: str,
         new_project_name: str,
+        block_by_unit: bool = False,
+        block_by_location: bool = False,
+        location_parents: dict = None,
+        fuzzy_prefilter_limit: int = PREFILTER_LIMIT,
+        cache_path: str = None,
+        cache_size: int = None,
+        checkpoint_path: str = None,
+        biosphere_synonyms: dict = None,
+        location_fallbacks: dict = None,
+        location_fallback: bool = False,
     ) -> None:
         """
         Initializes the migrator with the specified old and new database and project names.
@@ -29,12 +811,190 @@ class ActivityProjectMigrator:
         - old_project_name (str): Name of the old project.
         - new_db_name (str): Name of the new database.
         - new_project_name (str): Name of the new project.
+        - block_by_unit (bool): If True, fuzzy matching only considers activities with the same unit.
+        - block_by_location (bool): If True, fuzzy matching only considers activities with the same unit
+            and the same or a parent location.
+        - location_parents (dict): Maps a location to its parent locations used for blocking,
+            e.g. {"DE": ["RER"]}. "GLO" is always treated as a parent.
+        - fuzzy_prefilter_limit (int): Number of candidates, picked by shared tokens and trigrams,
+            that are fully scored by fuzzy matching. None scores every candidate.
+        - cache_path (str): Optional path of a sqlite file keeping migration results across runs.
+            Results are dropped automatically when the old or new database is modified by something else.
+            Call save_cache() at the end of a run to write the remaining results.
+        - cache_size (int): Maximum number of results kept in memory, least recently used ones are evicted.
+            None keeps everything. See cache.stats() for hit, miss and eviction counts.
+        - checkpoint_path (str): Optional path of a file where the results, the created activities and
+            the activities still to create are logged after every write to the new database and by save_cache().
+            Only the changes since the previous checkpoint are appended. An interrupted run is continued with resume().
+        - biosphere_synonyms (dict): Old name -> new name of renamed biosphere flows, added to (and overriding)
+            the built-in BIOSPHERE_SYNONYMS. Names are compared normalized, so case and spacing don't matter.
+        - location_fallbacks (dict): Maps a location to the locations, in order of preference, whose activity is used
+            when the new database has the same activity but not in that location, e.g. {"RER": ["RER w/o CH", "CH"]}.
+            By default these are the parent locations of location_parents, then "GLO", then "RoW".
+            Giving location_fallbacks turns location_fallback on.
+        - location_fallback (bool): If True, activities missing in their own location are matched to the same activity
+            in a fallback location before fuzzy matching. Off by default, so results don't change unless asked for.
         """
         self.old_db_name = old_db_name
         self.old_project_name = old_project_name
         self.new_db_name = new_db_name
         self.new_project_name = new_project_name
-        self.cache = {}
+        self.block_by_unit = block_by_unit or block_by_location
+        self.block_by_location = block_by_location
+        self.location_parents = location_parents or {}
+        self.location_fallbacks = location_fallbacks or {}
+        self.location_fallback = location_fallback or location_fallbacks is not None
+        self.fuzzy_prefilter_limit = fuzzy_prefilter_limit
+        # old key -> Resolution, the return shape asked for is derived from it, see _format_result
+        self.cache = MigrationCache(max_size=cache_size)
+        # old key -> key of the activity created for it during this session
+        # one entry per activity written to the new database, it's what prevents creating one twice
+        # and what rollback() deletes, so it isn't bounded like the cache
+        self.created = {}
+        # phase -> seconds of the last migrate_many call
+        self.last_timings = {}
+        self.project_switches = 0
+        # new activities and exchanges waiting to be written to the new project, see _buffered_writes
+        self._writer = _BulkWriter()
+        self._write_depth = 0
+        # old keys of activities waiting to be created, see _run_worklist
+        self._worklist = []
+        self.checkpoint_path = checkpoint_path
+        self._last_checkpoint = time.monotonic()
+        # changes not appended to the checkpoint yet, and whether this migrator started its file, see _checkpoint
+        self._checkpoint_entries = []
+        self._checkpoint_started = False
+        # old database name -> {old key -> keys of its technosphere inputs}, see _dependency_graph
+        self._dependency_graphs = {}
+        self._own_writes = False
+        # old key -> the fields of an old node needed for matching, so exchange inputs can be
+        # matched in the new project without switching back, see _load_old_nodes
+        # only kept for the current operation, it's cleared when its writes are done, see _buffered_writes
+        self._old_nodes = {}
+        # (name, location, unit, reference product) -> key of the first matching activity in the new database
+        # built lazily on the first exact lookup, see _get_exact_index
+        self._exact_index = None
+        # the same with normalized names and reference products, built together with it, see _normalized_key
+        self._normalized_index = None
+        # (normalized name, unit, normalized reference product) -> {location -> key}, built together with it,
+        # see _location_lookup
+        self._location_index = None
+        # old code -> new key from loaded correspondence tables, see load_correspondence
+        self._correspondence = {}
+        # biosphere name -> {compared fields -> {field values -> key of the first matching flow}}
+        # see _get_biosphere_index
+        self._biosphere_indexes = {}
+        self._biosphere_flows = {}
+        # normalized old name -> new name of renamed biosphere flows, see _handle_biosphere_migration
+        self._biosphere_synonyms = {
+            _normalize(old_name): new_name
+            for old_name, new_name in {
+                **BIOSPHERE_SYNONYMS,
+                **(biosphere_synonyms or {}),
+            }.items()
+        }
+        # (project, database name, biosphere) -> _FuzzyCorpus, see _get_corpus
+        self._corpora = {}
+        # results of earlier runs are read from the file on cache misses, see _lookup
+        self._persistent = None
+        # new key -> details of the activities reserved by _schedule_creation that aren't written yet
+        self._unwritten = {}
+        # new key -> (old key, resolution) pairs pointing to an activity that isn't written yet, see _store
+        self._awaiting_write = {}
+        if cache_path is not None:
+            self._persistent = _PersistentCache(
+                cache_path,
+                (old_project_name, old_db_name, new_project_name, new_db_name),
+            )
+            self._set_project(old_project_name)
+            old_modified = bd.databases[old_db_name].get("modified")
+            self._set_project(new_project_name)
+            self._persistent.validate(
+                old_modified, bd.databases[new_db_name].get("modified")
+            )
+
+    def load_correspondence(
+        self,
+        path: str,
+        old_column: str = "old",
+        new_column: str = "new",
+        sheet_name: str = None,
+        verbose: bool = False,
+    ) -> dict:
+        """
+        Loads a correspondence table mapping codes of the old database to codes of the new database,
+        e.g. built from the ecoinvent correspondence files. Once loaded, it's the first thing looked at
+        when migrating an activity, before reading the old activity or any matching.
+        Several tables can be loaded, later ones add to (and override) earlier ones.
+        Load tables before migrating, results that are already cached aren't changed.
+
+        Parameters:
+        ----------
+        - path (str): Path of a .csv, .xlsx (needs openpyxl) or .json file. A json file holds either a list of rows
+            or a single {old code: new code or list of new codes} dictionary.
+        - old_column (str): Name of the column with the old codes.
+        - new_column (str): Name of the column with the new codes.
+        - sheet_name (str): Sheet of an Excel file, the first one by default.
+        - verbose (bool): If True, prints a summary of the report.
+
+        Returns:
+        -------
+        - dict: A report of the table with:
+            - "entries": the number of old codes mapped to exactly one new activity, these are used for migration.
+            - "splits": maps old codes mapped to several new codes to these codes. They are not used, the other
+              matching steps decide between them.
+            - "merges": maps new codes that several old codes are mapped to, to these old codes.
+            - "missing": new codes that aren't in the new database, their rows are ignored.
+        """
+        table = {}
+        for row in _read_table(path, sheet_name=sheet_name):
+            old_code, new_codes = row.get(old_column), row.get(new_column)
+            if old_code in (None, "") or new_codes in (None, ""):
+                continue
+            if not isinstance(new_codes, list):
+                new_codes = [new_codes]
+            codes = table.setdefault(str(old_code).strip(), [])
+            for new_code in new_codes:
+                if str(new_code).strip() not in codes:
+                    codes.append(str(new_code).strip())
+
+        # only keep codes of activities that exist in the new database, checked in bulk
+        self._set_project(self.new_project_name)
+        wanted = list({code for codes in table.values() for code in codes})
+        existing = set()
+        for start in range(0, len(wanted), QUERY_CHUNK_SIZE):
+            existing.update(
+                code
+                for code, in ActivityDataset.select(ActivityDataset.code)
+                .where(
+                    (ActivityDataset.database == self.new_db_name)
+                    & (ActivityDataset.code << wanted[start : start + QUERY_CHUNK_SIZE])
+                )
+                .tuples()
+            )
+
+        report = {"entries": 0, "splits": {}, "merges": {}, "missing": []}
+        report["missing"] = sorted(code for code in wanted if code not in existing)
+        sources = {}
+        for old_code, codes in table.items():
+            codes = [code for code in codes if code in existing]
+            if len(codes) > 1:
+                report["splits"][old_code] = codes
+            elif codes:
+                self._correspondence[old_code] = (self.new_db_name, codes[0])
+                sources.setdefault(codes[0], []).append(old_code)
+        report["merges"] = {
+            new_code: old_codes
+            for new_code, old_codes in sources.items()
+            if len(old_codes) > 1
+        }
+        report["entries"] = sum(len(old_codes) for old_codes in sources.values())
+        if verbose:
+            print(
+                f"Loaded {report['entries']} correspondences from '{path}': {len(report['splits'])} splits, "
+                f"{len(report['merges'])} merges, {len(report['missing'])} missing new codes"
+            )
+        return report
 
     def migrate_activity(
         self,
@@ -65,64 +1025,117 @@ class ActivityProjectMigrator:
         -------
         - tuple: A tuple containing the migrated activity and a boolean indicating whether the activity was created.
             - (activity, True) if the activity was created or found.
-            - (activity, False) if the activity was not found.
+            - (activity, False) if the activity was not found, with the old activity.
             - (activity_code, True) if the activity was created or found and return_code_only is True.
-            - (activity_code, False) if the activity was created or found and return_code_only is True.
+            - (activity_code, False) if the activity was not found and return_code_only is True, with the old code.
             - (activity_key, True) if the activity was created or found and return_key_only is True.
-            - (activity_key, False) if the activity was created or found and return_key_only is True.
+            - (activity_key, False) if the activity was not found and return_key_only is True, with the old key.
+            The result is cached once per old activity, the shape is derived from the flags of each call.
         """
-        # Check cache first
-        if old_activity_code in self.cache:
-            return self.cache[old_activity_code]
+        old_key = self._old_key(old_activity_code, by_key)
+        # Check cache first, then the correspondence tables, which don't need the old activity
+        resolution = self._lookup(old_key, fuzzy_match, fuzzy_match_score)
+        if resolution is None:
+            resolution = self._correspondence_lookup(old_key)
+            if resolution is not None:
+                self._store(old_key, resolution)
+        if resolution is None:
+            # Set current project to old project and access the old database
+            self._set_project(self.old_project_name)
+            old_db = bd.Database(self.old_db_name)
 
-        # Set current project to old project and access the old database
-        bd.projects.set_current(self.old_project_name)
-        old_db = bd.Database(self.old_db_name)
+            try:
+                # Fetch the activity from the old database
+                if by_key:
+                    activity = bd.get_activity(old_activity_code)
+                else:
+                    activity = old_db.get(old_activity_code)
+            except Exception as e:
+                raise ValueError(
+                    f"Activity code '{old_activity_code}' doesn't exist in the old database '{self.old_db_name}'"
+                ) from e
 
-        try:
-            # Fetch the activity from the old database
-            if by_key:
-                activity = bd.get_activity(old_activity_code)
-            else:
-                activity = old_db.get(old_activity_code)
-        except Exception as e:
-            raise ValueError(
-                f"Activity code '{old_activity_code}' doesn't exist in the old database '{self.old_db_name}'"
-            ) from e
+            # Prepare activity details for comparison
+            if verbose:
+                print(f"Extracting Activity details: {activity}")
+            activity_details = self._extract_activity_details(activity)
+            resolution = self._resolve(
+                old_key,
+                activity_details,
+                fuzzy_match=fuzzy_match,
+                fuzzy_match_score=fuzzy_match_score,
+                verbose=verbose,
+            )
 
-        # Prepare activity details for comparison
-        if verbose:
-            print(f"Extracting Activity details: {activity}")
-        activity_details = self._extract_activity_details(activity)
+        # If no matching activity is found, create one if specified
+        if resolution.new_key is None and create_if_not_found:
+            if verbose:
+                print(f"Activity not found, Creating activity: {old_key}")
+            new_key, _ = self.create_activity_if_not_found(
+                old_activity_code,
+                by_key=by_key,
+                biosphere_name=biosphere_name,
+                verbose=verbose,
+            )
+            resolution = Resolution(new_key, "created", None)
+        elif resolution.new_key in self._unwritten:
+            # reserved by a run that failed before writing it, create it before handing out its key
+            self._run_worklist(biosphere_name=biosphere_name, verbose=verbose)
+        return self._format_result(
+            old_key, resolution, return_code_only, return_key_only
+        )
+
+    def _resolve(
+        self,
+        old_key: tuple,
+        activity_details: dict,
+        fuzzy_match: bool = True,
+        fuzzy_match_score: int = 85,
+        verbose: bool = False,
+    ) -> Resolution:
+        """
+        Internal method.
+        The new project side of migrate_activity: matches already extracted activity details
+        against the new database, so callers that read the old project in bulk don't need to switch back to it.
+        The resolution is cached, including when nothing was found.
+
+        Parameters:
+        ----------
+        - old_key (tuple): Key of the activity in the old database.
+        - activity_details (dict): The details of the old activity, see _extract_activity_details.
+        - fuzzy_match, fuzzy_match_score, verbose: same as in migrate_activity.
 
+        Returns:
+        -------
+        - Resolution: The new key (None if not found), how it was found and the fuzzy score if any.
+        """
         # Switch to the new project and database
-        bd.projects.set_current(self.new_project_name)
-        new_db = bd.Database(self.new_db_name)
+        self._set_project(self.new_project_name)
+
+        # Created earlier in this session, possibly under its code instead of its key
+        new_key = self.created.get(old_key)
+        if new_key is not None:
+            return self._store(old_key, Resolution(new_key, "created", None))
+
+        resolution = self._correspondence_lookup(old_key)
+        if resolution is not None:
+            return self._store(old_key, resolution)
 
         # Search for a matching activity in the new database
-        for new_activity in new_db:
-            if all(
-                new_activity[key] == value for key, value in activity_details.items()
-            ):
-                # return key if specified by or if return code only if specified otherwise return activity
-                if return_key_only:
-                    result = (new_activity.key, True)
-                elif return_code_only:
-                    result = (new_activity["code"], True)
-                else:
-                    result = (new_activity, True)
-                self.cache[old_activity_code] = result
-                if verbose:
-                    print(
-                        f"Found equivalent activity: {new_activity} to query: {activity_details}"
-                    )
-                return result
+        resolution = self._index_lookup(activity_details)
+        if resolution is not None:
+            if verbose:
+                print(
+                    f"Found equivalent activity: {resolution.new_key} to query: {activity_details}"
+                )
+            return self._store(old_key, resolution)
 
         # If no match try to fuzzy match with a high accuracy
         # The reason for this, is as always weirdness in the ecoinvent database
         # for example: there was an activity in the old database with the name iron (III) chloride production, product in 40% solution state
         # now it's iron(III) chloride production, product in 40% solution state
         # the only difference is the space between iron and the parenthesis
+        # (that one is caught by the normalized index now, fuzzy matching is for what's left)
         if fuzzy_match:
             if verbose:
                 print(
@@ -130,30 +1143,707 @@ class ActivityProjectMigrator:
                 )
             query = f"{activity_details['name']} {activity_details['location']} {activity_details['reference product']}"
             fuzzy_new_activity = self._find_closest_match(
-                query, new_db, score_cutoff=fuzzy_match_score, biosphere=False
+                query,
+                self.new_db_name,
+                score_cutoff=fuzzy_match_score,
+                biosphere=False,
+                block=self._fuzzy_block(activity_details),
             )
-            print("#" * 50)
-            print(fuzzy_new_activity)
             if fuzzy_new_activity:
                 if verbose:
                     print(f"Fuzzy match found: {fuzzy_new_activity} ")
-                if len(fuzzy_new_activity) == 1:
-                    fuzzy_new_activity = fuzzy_new_activity[0]
-                    return (fuzzy_new_activity.key, True)
-                elif len(fuzzy_new_activity) > 1:
-                    fuzzy_new_activity = fuzzy_new_activity[0]
+                if len(fuzzy_new_activity) > 1:
                     print(
-                        f"Multiple matches found for query: {query}, returning the first match: {fuzzy_new_activity}"
+                        f"Multiple matches found for query: {query}, returning the first match: {fuzzy_new_activity[0]}"
                     )
-                    return (fuzzy_new_activity.key, True)
-        # If no matching activity is found, create one if specified
-        if create_if_not_found:
+                new_key, score = fuzzy_new_activity[0]
+                return self._store(old_key, Resolution(new_key, "fuzzy", score))
+        return self._store(
+            old_key,
+            Resolution(None, "not_found", fuzzy_match_score if fuzzy_match else None),
+        )
+
+    def migrate_many(
+        self,
+        old_activity_codes: list,
+        return_code_only: bool = False,
+        create_if_not_found: bool = False,
+        return_key_only: bool = True,
+        by_key: bool = False,
+        biosphere_name: str = "biosphere3",
+        verbose: bool = False,
+        fuzzy_match: bool = True,
+        fuzzy_match_score: int = 85,
+    ) -> dict:
+        """
+        Migrates a batch of activities in one pass.
+        All old activities are read in one go from the old project, then all of them are matched
+        in the new project using the shared indexes, with a single batch fuzzy matching step for the ones
+        without an exact match. Activities that still have no match are created if specified.
+        The time spent in each phase is stored in self.last_timings.
+
+        Parameters:
+        ----------
+        - old_activity_codes (list): Codes (or keys if by_key is True) of the activities in the old database.
+        - return_code_only, create_if_not_found, return_key_only, by_key, biosphere_name, verbose, fuzzy_match,
+            fuzzy_match_score: same as in migrate_activity.
+
+        Returns:
+        -------
+        - dict: A dictionary mapping each old code to the same result tuple migrate_activity would return.
+        """
+        timings = {}
+        old_keys = {
+            code: self._old_key(code, by_key)
+            for code in dict.fromkeys(old_activity_codes)
+        }
+        resolutions = {}
+        for code, old_key in old_keys.items():
+            resolution = self._lookup(old_key, fuzzy_match, fuzzy_match_score)
+            # activities cached as not found are looked at again if they should be created
+            if resolution is None:
+                resolution = self._correspondence_lookup(old_key)
+                if resolution is not None:
+                    self._store(old_key, resolution)
+            if resolution is not None and (
+                resolution.new_key is not None or not create_if_not_found
+            ):
+                resolutions[code] = resolution
+        pending = [code for code in old_keys if code not in resolutions]
+
+        # Read all old activities in one project context
+        start = time.perf_counter()
+        self._set_project(self.old_project_name)
+        old_activities = self._read_old_activities(pending, by_key=by_key)
+        details = {
+            code: self._extract_activity_details(old_activities[code])
+            for code in pending
+        }
+        timings["read"] = time.perf_counter() - start
+
+        # Exact and normalized matches through the indexes
+        start = time.perf_counter()
+        self._set_project(self.new_project_name)
+        unmatched = []
+        for code in pending:
+            new_key = self.created.get(old_keys[code])
+            if new_key is not None:
+                resolution = Resolution(new_key, "created", None)
+            else:
+                resolution = self._index_lookup(details[code])
+                if resolution is None:
+                    unmatched.append(code)
+                    continue
+            resolutions[code] = self._store(old_keys[code], resolution)
+        timings["exact"] = time.perf_counter() - start
+
+        # Fuzzy match everything left in one batch
+        start = time.perf_counter()
+        if fuzzy_match and unmatched:
+            matches = self._get_corpus(self.new_db_name, biosphere=False).search(
+                [
+                    f"{details[code]['name']} {details[code]['location']} {details[code]['reference product']}"
+                    for code in unmatched
+                ],
+                score_cutoff=fuzzy_match_score,
+                limit=1,
+                blocks=[self._fuzzy_block(details[code]) for code in unmatched],
+                prefilter_limit=self.fuzzy_prefilter_limit,
+            )
+            still_unmatched = []
+            for code, code_matches in zip(unmatched, matches):
+                if code_matches:
+                    if verbose:
+                        print(f"Fuzzy match found for {code}: {code_matches[0]}")
+                    new_key, score = code_matches[0]
+                    resolutions[code] = self._store(
+                        old_keys[code], Resolution(new_key, "fuzzy", score)
+                    )
+                else:
+                    still_unmatched.append(code)
+            unmatched = still_unmatched
+        timings["fuzzy"] = time.perf_counter() - start
+
+        # Create or give up on the rest
+        start = time.perf_counter()
+        for code in unmatched:
+            if create_if_not_found:
+                if verbose:
+                    print(f"Activity not found, Creating activity: {details[code]}")
+                new_key = self.created.get(old_keys[code]) or self._schedule_creation(
+                    old_keys[code], details[code]
+                )
+                resolutions[code] = Resolution(new_key, "created", None)
+            else:
+                resolutions[code] = self._store(
+                    old_keys[code],
+                    Resolution(
+                        None, "not_found", fuzzy_match_score if fuzzy_match else None
+                    ),
+                )
+        self._run_worklist(biosphere_name=biosphere_name, verbose=verbose)
+        timings["create"] = time.perf_counter() - start
+
+        self.save_cache()
+        self.last_timings = timings
+        if verbose:
+            print(f"Migrated {len(pending)} activities, timings (s): {timings}")
+        return {
+            code: self._format_result(
+                old_key, resolutions[code], return_code_only, return_key_only
+            )
+            for code, old_key in old_keys.items()
+        }
+
+    def migrate_database(
+        self,
+        source_db: str,
+        target_db: str,
+        create_if_not_found: bool = False,
+        biosphere_name: str = "biosphere3",
+        chunk_size: int = QUERY_CHUNK_SIZE,
+        verbose: bool = False,
+        fuzzy_match: bool = True,
+        fuzzy_match_score: int = 85,
+    ):
+        """
+        Migrates a whole (foreground) database of the old project to a new database of the new project.
+        The activities are copied with all their data, exchanges between them stay between the copies,
+        and the other technosphere and biosphere exchanges are relinked to the new database and biosphere
+        with the usual matching. The source database is read in chunks, each chunk is written before the next
+        one is read, so memory use doesn't depend on the size of the source database.
+        Activities already copied to the target database with all their exchanges are skipped, so an interrupted
+        migration can simply be run again. The others (e.g. with unlinked exchanges) are copied again.
+
+        This is a generator, nothing happens until it's iterated:
+
+            for progress in migrator.migrate_database("my foreground", "my foreground new"):
+                print(progress)
+
+        Parameters:
+        ----------
+        - source_db (str): Name of the database in the old project.
+        - target_db (str): Name of the database in the new project, created if it doesn't exist.
+        - create_if_not_found (bool): If True, technosphere inputs without a match are created in the new database.
+            Otherwise the exchange is left out and reported as unlinked.
+        - chunk_size (int): Number of activities read, matched and written at a time.
+        - biosphere_name, verbose, fuzzy_match, fuzzy_match_score: same as in migrate_activity.
+
+        Yields:
+        -------
+        - dict: A progress record per chunk with the number of activities "done" out of "total",
+            the number of "exchanges" written, the number of activities "created" in the new database
+            and the "unlinked" exchanges of the chunk as (activity code, old input key) tuples.
+        """
+        if target_db == self.new_db_name:
+            raise ValueError(
+                f"The target database can't be the new database '{self.new_db_name}' itself"
+            )
+        self._set_project(self.old_project_name)
+        if source_db not in bd.databases:
+            raise ValueError(
+                f"Database '{source_db}' doesn't exist in the old project '{self.old_project_name}'"
+            )
+        total = (
+            ActivityDataset.select()
+            .where(ActivityDataset.database == source_db)
+            .count()
+        )
+        self._set_project(self.new_project_name)
+        if target_db not in bd.databases:
+            bd.Database(target_db).register()
+
+        done = 0
+        last_id = 0
+        while True:
+            # Read a chunk of activities and their exchanges in the old project
+            self._set_project(self.old_project_name)
+            rows = list(
+                ActivityDataset.select(
+                    ActivityDataset.id, ActivityDataset.code, ActivityDataset.data
+                )
+                .where(
+                    (ActivityDataset.database == source_db)
+                    & (ActivityDataset.id > last_id)
+                )
+                .order_by(ActivityDataset.id)
+                .limit(chunk_size)
+                .tuples()
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            exchanges = {code: [] for _, code, _ in rows}
+            for output_code, data in (
+                ExchangeDataset.select(
+                    ExchangeDataset.output_code, ExchangeDataset.data
+                )
+                .where(
+                    (ExchangeDataset.output_database == source_db)
+                    & (ExchangeDataset.output_code << list(exchanges))
+                )
+                .order_by(ExchangeDataset.id)
+                .tuples()
+            ):
+                exchanges[output_code].append(data)
+            self._load_old_nodes(
+                [
+                    tuple(exc["input"])
+                    for excs in exchanges.values()
+                    for exc in excs
+                    if exc["input"][0] != source_db
+                ]
+            )
+
+            # Relink and write the chunk in the new project
+            self._set_project(self.new_project_name)
+            created = len(self.created)
+            record = {"done": 0, "total": total, "exchanges": 0, "created": 0}
+            unlinked = []
+            # activities already copied by an earlier, interrupted run are skipped
+            existing = self._complete_copies(
+                target_db, {code: len(excs) for code, excs in exchanges.items()}
+            )
+            with self._buffered_writes():
+                for _, code, data in rows:
+                    if code in existing:
+                        continue
+                    new_key = self._writer.add_activity(
+                        dict(data, database=target_db, code=code)
+                    )
+                    for exc in exchanges[code]:
+                        input_key = tuple(exc["input"])
+                        if input_key[0] == source_db:
+                            new_input = (target_db, input_key[1])
+                        elif exc["type"] == "biosphere":
+                            node = self._old_nodes[input_key]
+                            try:
+                                new_input = self._handle_biosphere_migration(
+                                    {
+                                        "input": input_key,
+                                        "name": node["name"],
+                                        "unit": node["unit"],
+                                        "categories": node["categories"],
+                                        "CAS number": node["CAS number"],
+                                    },
+                                    biosphere_name=biosphere_name,
+                                    verbose=verbose,
+                                )[0]
+                            except ValueError:
+                                new_input = None
+                        else:
+                            resolution = self._lookup(
+                                input_key, fuzzy_match, fuzzy_match_score
+                            )
+                            if resolution is None:
+                                resolution = self._resolve(
+                                    input_key,
+                                    self._extract_activity_details(
+                                        self._old_nodes[input_key]
+                                    ),
+                                    fuzzy_match=fuzzy_match,
+                                    fuzzy_match_score=fuzzy_match_score,
+                                    verbose=verbose,
+                                )
+                            new_input = resolution.new_key
+                            if new_input is None and create_if_not_found:
+                                new_input = self.created.get(
+                                    input_key
+                                ) or self._schedule_creation(
+                                    input_key,
+                                    self._extract_activity_details(
+                                        self._old_nodes[input_key]
+                                    ),
+                                )
+                        if new_input is None:
+                            unlinked.append((code, input_key))
+                            continue
+                        self._writer.add_exchange(
+                            dict(exc, input=new_input, output=new_key)
+                        )
+                        record["exchanges"] += 1
+                self._run_worklist(biosphere_name=biosphere_name, verbose=verbose)
+            self.save_cache()
+
+            done += len(rows)
+            record.update(
+                done=done, created=len(self.created) - created, unlinked=unlinked
+            )
             if verbose:
-                print(f"Activity not found, Creating activity: {activity_details}")
-            return self.create_activity_if_not_found(old_activity_code, verbose=verbose)
-        result = (activity, False)
-        self.cache[old_activity_code] = result
-        return result
+                print(f"Migrated {done}/{total} activities of '{source_db}'")
+            yield record
+
+    def _complete_copies(self, target_db: str, expected: dict) -> set:
+        """
+        Internal method.
+        Finds the activities of a chunk that were completely copied to the target database by an earlier run:
+        they exist, have as many exchanges as the source activity, and every input outside the target database
+        exists. Copies that don't pass are deleted (keeping the exchanges pointing to them), so they are copied again.
+        Expects the new project to be the current project.
+
+        Parameters:
+        - target_db (str): Name of the target database.
+        - expected (dict): Maps the codes of the chunk to the number of exchanges of the source activity.
+
+        Returns:
+        - set: The codes of the complete copies.
+        """
+        existing = {
+            code
+            for code, in ActivityDataset.select(ActivityDataset.code)
+            .where(
+                (ActivityDataset.database == target_db)
+                & (ActivityDataset.code << list(expected))
+            )
+            .tuples()
+        }
+        if not existing:
+            return existing
+        counts = dict.fromkeys(existing, 0)
+        inputs = {}
+        for output_code, input_database, input_code in (
+            ExchangeDataset.select(
+                ExchangeDataset.output_code,
+                ExchangeDataset.input_database,
+                ExchangeDataset.input_code,
+            )
+            .where(
+                (ExchangeDataset.output_database == target_db)
+                & (ExchangeDataset.output_code << list(existing))
+            )
+            .tuples()
+        ):
+            counts[output_code] += 1
+            # the other activities of the target database may simply not be copied yet
+            if input_database != target_db:
+                inputs.setdefault(input_database, {}).setdefault(input_code, set()).add(
+                    output_code
+                )
+        complete = {code for code in existing if counts[code] == expected[code]}
+        for database, input_codes in inputs.items():
+            wanted = list(input_codes)
+            found = set()
+            for start in range(0, len(wanted), QUERY_CHUNK_SIZE):
+                found.update(
+                    code
+                    for code, in ActivityDataset.select(ActivityDataset.code)
+                    .where(
+                        (ActivityDataset.database == database)
+                        & (
+                            ActivityDataset.code
+                            << wanted[start : start + QUERY_CHUNK_SIZE]
+                        )
+                    )
+                    .tuples()
+                )
+            for code in wanted:
+                if code not in found:
+                    complete -= input_codes[code]
+        incomplete = existing - complete
+        if incomplete:
+            self._delete_activities(
+                [(target_db, code) for code in incomplete], inbound=False
+            )
+        return complete
+
+    def plan_migration(
+        self,
+        old_activity_codes: list,
+        by_key: bool = False,
+        biosphere_name: str = "biosphere3",
+        verbose: bool = False,
+        fuzzy_match: bool = True,
+        fuzzy_match_score: int = 85,
+    ) -> dict:
+        """
+        Dry run of migrate_many with create_if_not_found=True: tells what the migration would do without
+        writing anything to the new project. Matches found on the way are cached like in a real run.
+        The old project is read in bulk and the new database through the same indexes as a real run,
+        so this is cheap enough to run routinely, e.g. to check a model before migrating it.
+
+        Parameters:
+        ----------
+        - old_activity_codes (list): Codes (or keys if by_key is True) of the activities in the old database.
+        - by_key, biosphere_name, verbose, fuzzy_match, fuzzy_match_score: same as in migrate_activity.
+
+        Returns:
+        -------
+        - dict: A dictionary with:
+            - "activities": maps each old code to a dict with "kind", "key" and "score". The kind is "correspondence",
+              "exact", "normalized", "location", "fuzzy" (with its score), "created" (by an earlier call of this migrator) or "create",
+              in which case the key is None.
+            - "create": old keys of every activity that would be created, the requested ones and
+              the inputs they need, in creation order.
+            - "cycles": lists of old keys of activities to create that depend on each other.
+            - "biosphere": maps the old key of each biosphere flow used by the activities to create to
+              the new flow it would be linked to, or None if there is none, which would stop the migration.
+        """
+        old_keys = {
+            code: self._old_key(code, by_key)
+            for code in dict.fromkeys(old_activity_codes)
+        }
+        self._set_project(self.old_project_name)
+        nodes = self._load_old_nodes(list(old_keys.values()))
+
+        activities = {}
+        roots = {}
+        for code, old_key in old_keys.items():
+            resolution = self._lookup(old_key, fuzzy_match, fuzzy_match_score)
+            if resolution is None:
+                resolution = self._resolve(
+                    old_key,
+                    self._extract_activity_details(nodes[old_key]),
+                    fuzzy_match=fuzzy_match,
+                    fuzzy_match_score=fuzzy_match_score,
+                    verbose=verbose,
+                )
+            if resolution.new_key is None:
+                roots[old_key] = None
+                activities[code] = {"kind": "create", "key": None, "score": None}
+            else:
+                activities[code] = {
+                    "kind": resolution.kind,
+                    "key": resolution.new_key,
+                    "score": resolution.score,
+                }
+
+        components = (
+            self._plan_creation(list(roots), dry_run=True, verbose=verbose)
+            if roots
+            else []
+        )
+        order = [old_key for component in components for old_key in component]
+
+        # the biosphere flows are only looked up, they are never created
+        self._set_project(self.old_project_name)
+        exchanges = self._collect_exchange_details(order)
+        self._set_project(self.new_project_name)
+        biosphere = {}
+        for exchange_details_list in exchanges.values():
+            for exchange_details in exchange_details_list:
+                if (
+                    exchange_details["type"] != "biosphere"
+                    or exchange_details["input"] in biosphere
+                ):
+                    continue
+                try:
+                    new_flow = self._handle_biosphere_migration(
+                        exchange_details, biosphere_name=biosphere_name
+                    )[0]
+                except ValueError:
+                    new_flow = None
+                biosphere[exchange_details["input"]] = new_flow
+
+        self._old_nodes.clear()
+        if verbose:
+            print(
+                f"Plan: {len(order)} activities to create, {sum(1 for flow in biosphere.values() if flow is None)} biosphere flows not found"
+            )
+        return {
+            "activities": activities,
+            "create": order,
+            "cycles": [component for component in components if len(component) > 1],
+            "biosphere": biosphere,
+        }
+
+    def _read_old_activities(
+        self, old_activity_codes: list, by_key: bool = False
+    ) -> dict:
+        """
+        Internal method.
+        Reads many activities with a few bulk queries instead of one query per activity.
+        Expects the old project to be the current project.
+
+        Parameters:
+        - old_activity_codes (list): Codes of activities in the old database, or keys if by_key is True.
+        - by_key (bool): If True, old_activity_codes are (database, code) keys.
+
+        Returns:
+        - dict: A dictionary mapping each given code or key to its Activity object.
+        """
+        codes_by_database = {}
+        for code in old_activity_codes:
+            database, activity_code = code if by_key else (self.old_db_name, code)
+            codes_by_database.setdefault(database, {})[activity_code] = code
+        activities = {}
+        for database, codes in codes_by_database.items():
+            code_list = list(codes)
+            for start in range(0, len(code_list), QUERY_CHUNK_SIZE):
+                for dataset in ActivityDataset.select().where(
+                    (ActivityDataset.database == database)
+                    & (
+                        ActivityDataset.code
+                        << code_list[start : start + QUERY_CHUNK_SIZE]
+                    )
+                ):
+                    activities[codes[dataset.code]] = Activity(dataset)
+        missing = [code for code in old_activity_codes if code not in activities]
+        if missing:
+            raise ValueError(
+                f"Activity codes {missing} don't exist in the old database '{self.old_db_name}'"
+            )
+        return activities
+
+    @contextmanager
+    def _buffered_writes(self):
+        """
+        Internal method.
+        Context manager buffering new activities and exchanges in self._writer.
+        Contexts can be nested, everything is written when the outermost one exits.
+        The old nodes read for the operation are released then as well, see _load_old_nodes.
+        """
+        self._write_depth += 1
+        try:
+            yield self._writer
+        finally:
+            self._write_depth -= 1
+            if self._write_depth == 0:
+                self._old_nodes.clear()
+        if self._write_depth == 0:
+            self.flush_writes()
+
+    def flush_writes(self) -> bool:
+        """
+        Writes all buffered activities and exchanges to the new database, then saves a checkpoint if enabled.
+        This is done automatically at the end of each migration call, and when the buffer gets large.
+        Returns True if anything was written.
+        """
+        if not len(self._writer):
+            return False
+        self._set_project(self.new_project_name)
+        written = [(data["database"], data["code"]) for data in self._writer.activities]
+        self._writer.flush()
+        self._own_writes = True
+        # results pointing to activities that weren't written yet only go to the persistent cache now, see _store
+        for new_key in written:
+            if self._unwritten.pop(new_key, None) is not None:
+                self._log("written", new_key)
+            for old_key, resolution in self._awaiting_write.pop(new_key, ()):
+                self._persistent.add(old_key, resolution)
+        self._checkpoint()
+        return True
+
+    def _old_key(self, old_activity_code, by_key: bool) -> tuple:
+        """
+        Internal method.
+        Returns the key of an old activity given as code (or key if by_key is True).
+        """
+        return (
+            tuple(old_activity_code)
+            if by_key
+            else (self.old_db_name, old_activity_code)
+        )
+
+    def _lookup(
+        self, old_key: tuple, fuzzy_match: bool = True, fuzzy_match_score: int = 85
+    ):
+        """
+        Internal method.
+        Looks an old activity up in the in-memory cache, then in the persistent cache, if there is one.
+        Results that depend on the fuzzy matching settings are only used if they hold for the given ones:
+        fuzzy matches if fuzzy matching is on and their score reaches the cutoff, "not_found" if fuzzy matching
+        is off or was tried with the same or a lower cutoff. Otherwise the activity has to be matched again.
+
+        Parameters:
+        - old_key (tuple): Key of the activity in the old database.
+        - fuzzy_match, fuzzy_match_score: same as in migrate_activity.
+
+        Returns:
+        - Resolution or None: The cached resolution, None if the activity wasn't migrated before
+            or has to be matched again.
+        """
+        resolution = self.cache.get(old_key)
+        if resolution is None and self._persistent is not None:
+            resolution = self._persistent.get(old_key)
+            if resolution is not None:
+                self.cache[old_key] = resolution
+        if resolution is None:
+            return None
+        if resolution.kind == "fuzzy" and (
+            not fuzzy_match or resolution.score < fuzzy_match_score
+        ):
+            return None
+        if (
+            resolution.kind == "not_found"
+            and fuzzy_match
+            and (resolution.score is None or resolution.score > fuzzy_match_score)
+        ):
+            return None
+        return resolution
+
+    def _store(self, old_key: tuple, resolution: Resolution) -> Resolution:
+        """
+        Internal method.
+        Caches a resolution and queues it for the persistent cache, if there is one.
+        Resolutions pointing to an activity that isn't written yet, whether it was created for this old activity
+        or found for another one through the indexes or fuzzy matching, are only queued once it is written,
+        see flush_writes, so a failed run can't leave keys of activities that don't exist in the file.
+        Returns the resolution.
+        """
+        self.cache[old_key] = resolution
+        self._log(
+            "result", old_key, resolution.new_key, resolution.kind, resolution.score
+        )
+        if self._persistent is not None and resolution.new_key is not None:
+            if resolution.new_key in self._unwritten:
+                self._awaiting_write.setdefault(resolution.new_key, []).append(
+                    (old_key, resolution)
+                )
+            else:
+                self._persistent.add(old_key, resolution)
+        return resolution
+
+    def save_cache(self) -> None:
+        """
+        Writes the queued results to the persistent cache and the checkpoint, if there are.
+        Writes to the new database done by the migrator itself don't invalidate the cache.
+        """
+        if not self.flush_writes():
+            self._checkpoint()
+        if self._persistent is not None:
+            new_modified = None
+            if self._own_writes:
+                self._set_project(self.new_project_name)
+                new_modified = bd.databases[self.new_db_name].get("modified")
+                self._own_writes = False
+            self._persistent.flush(new_modified)
+
+    def _set_project(self, project_name: str) -> None:
+        """
+        Internal method.
+        Makes project_name the current project, skipping the switch if it already is.
+        Every real switch reconnects the sqlite databases, so they are counted in self.project_switches.
+        """
+        if bd.projects.current != project_name:
+            bd.projects.set_current(project_name)
+            self.project_switches += 1
+
+    def _format_result(
+        self,
+        old_key: tuple,
+        resolution: Resolution,
+        return_code_only: bool,
+        return_key_only: bool,
+    ) -> tuple:
+        """
+        Internal method.
+        Builds the result tuple of a resolution in the shape requested by the return flags.
+        If nothing was found, the key, code or node of the old activity is returned instead.
+        Nodes are only loaded here, when they are asked for.
+        """
+        found = resolution.new_key is not None
+        key = resolution.new_key if found else old_key
+        # return key if specified by or if return code only if specified otherwise return activity
+        if return_key_only:
+            return (key, found)
+        elif return_code_only:
+            return (key[1], found)
+        if found:
+            self.flush_writes()
+            self._set_project(self.new_project_name)
+        else:
+            self._set_project(self.old_project_name)
+        return (bd.get_node(database=key[0], code=key[1]), found)
 
     def _handle_biosphere_migration(
         self,
@@ -167,7 +1857,8 @@ class ActivityProjectMigrator:
 
         Parameters:
         ----------
-        - activity_details (dict): A dictionary containing details of the biosphere activity.
+        - activity_details (dict): A dictionary containing details of the biosphere activity: name and categories,
+            optionally its old key as "input" and its "CAS number".
         - biosphere_name (str): Name of the biosphere database.
 
         Returns:
@@ -178,35 +1869,67 @@ class ActivityProjectMigrator:
         """
 
         # Switch to the new project and database
-        bd.projects.set_current(self.new_project_name)
-        new_biosphere = bd.Database(biosphere_name)
-        print("#" * 50)
-        print(new_biosphere)
-        new_act = [
-            act
-            for act in new_biosphere
-            if all(
-                act.get(key) == value
-                for key, value in activity_details.items()
-                if value is not None
-                and key != "input"  # Add condition to ignore 'input' key
-                and key != "amount"  # Add condition to ignore 'amount' key
-                and key != "type"  # Add condition to ignore 'categories' key
+        self._set_project(self.new_project_name)
+        # Try the cheap and reliable lookups first, each one is a prebuilt index, see _get_biosphere_index:
+        # biosphere3 codes are the ecoinvent flow UUIDs, which are stable across versions,
+        # then the CAS number with the categories, then the name with the categories, then the new name
+        # of renamed flows with the categories
+        # Different flows can share a CAS number (e.g. fossil and non-fossil carbon dioxide),
+        # so a CAS number is only trusted when a single flow has it with these categories and unit
+        # Like before, the categories and unit are only compared if they are set
+        lookups = []
+        if activity_details.get("input") is not None:
+            lookups.append(({"code": activity_details["input"][1]}, False))
+        if activity_details.get("CAS number"):
+            lookups.append(
+                (
+                    {
+                        "CAS number": activity_details["CAS number"],
+                        "categories": activity_details.get("categories"),
+                        "unit": activity_details.get("unit"),
+                    },
+                    True,
+                )
             )
-        ]
-        print(new_act)
-        print("#" * 50)
-        print(activity_details)
-        if len(new_act) >= 1:
-            new_act = new_act[0]
+        lookups.append(
+            (
+                {
+                    "categories": activity_details.get("categories"),
+                    "name": activity_details["name"],
+                    "unit": activity_details.get("unit"),
+                },
+                False,
+            )
+        )
+        synonym = self._biosphere_synonyms.get(_normalize(activity_details["name"]))
+        if synonym is not None:
+            lookups.append(
+                (
+                    {
+                        "categories": activity_details.get("categories"),
+                        "normalized name": synonym,
+                        "unit": activity_details.get("unit"),
+                    },
+                    False,
+                )
+            )
+        new_act = None
+        for query, unique in lookups:
+            fields = tuple(field for field, value in query.items() if value is not None)
+            new_act = self._get_biosphere_index(
+                biosphere_name, fields, unique=unique
+            ).get(tuple(self._index_value(field, query[field]) for field in fields))
+            if new_act is not None:
+                break
+        if new_act is not None:
             if verbose:
-                print(f"Found equivalent biosphere activity: {new_act}")
-            return (new_act.key, True)
+                print(f"Found equivalent biosphere activity by {fields}: {new_act}")
+            return (new_act, True)
 
         else:
             # try to find a close match
             query = f"{activity_details['name']} {activity_details['categories']}"
-            new_act = self._find_closest_match(query, new_biosphere)
+            new_act = self._find_closest_match(query, biosphere_name)
             if verbose:
                 print(f"Closest match: {new_act} to query: {query}")
             if new_act is None:
@@ -214,11 +1937,114 @@ class ActivityProjectMigrator:
                     f"Activity '{activity_details['name']}' not found in the new database '{self.new_db_name}'"
                 )
             else:
-                new_act = new_act[0]
-                return (new_act.key, True)
+                return (new_act[0][0], True)
+
+    def _get_corpus(self, database_name: str, biosphere: bool) -> _FuzzyCorpus:
+        """
+        Internal method.
+        Returns the fuzzy matching corpus of a database in the current project, building it on first use.
+        The corpus is reused across all queries, activities reserved by the migrator are added to it
+        (see _FuzzyCorpus.add), it's only dropped when activities are deleted, see _invalidate_corpora.
+
+        Parameters:
+        - database_name (str): Name of the database.
+        - biosphere (bool): If True, the corpus is built for matching biosphere flows.
+
+        Returns:
+        - _FuzzyCorpus: The corpus of the database.
+        """
+        corpus_key = (bd.projects.current, database_name, biosphere)
+        if corpus_key not in self._corpora:
+            corpus = _FuzzyCorpus.from_database(database_name, biosphere)
+            # reserved activities are added instead of written first, this can be called while an activity
+            # is only partly buffered and writing it then would leave it without the rest of its exchanges
+            if database_name == self.new_db_name and not biosphere:
+                for new_key, activity_details in self._unwritten.items():
+                    corpus.add(
+                        _FuzzyCorpus.choice(activity_details, biosphere),
+                        new_key,
+                        unit=activity_details["unit"],
+                        location=activity_details["location"],
+                    )
+            self._corpora[corpus_key] = corpus
+        return self._corpora[corpus_key]
+
+    def find_closest_matches(
+        self,
+        queries: list[str],
+        database_name: str = None,
+        score_cutoff: int = 85,
+        limit: int = 5,
+        biosphere: bool = False,
+        blocks: list[tuple] = None,
+    ) -> list[list[tuple]]:
+        """
+        Fuzzy matches many queries at once against a database in the new project.
+        All queries are scored against the precomputed corpus of the database in one go,
+        which is a lot faster than calling _find_closest_match once per query.
+
+        Parameters:
+        ----------
+        - queries (list of str): The queries, formatted like the corpus choices
+            i.e. "name location reference product" or "name categories" for the biosphere.
+        - database_name (str): Name of the database to be searched, defaults to the new database.
+        - score_cutoff (int): The minimum score for a match to be considered.
+        - limit (int): The maximum number of matches returned per query.
+        - biosphere (bool): If True, the database is searched as a biosphere database.
+        - blocks (list of tuples): Optional, for each query a (unit, locations) tuple restricting its candidates
+            to the given unit and locations (None for any location), or None to search the whole database.
+
+        Returns:
+        -------
+        - list of lists: For each query, a list of (key, score) tuples sorted by descending score.
+            The list is empty if nothing scored above score_cutoff.
+        """
+        self._set_project(self.new_project_name)
+        corpus = self._get_corpus(database_name or self.new_db_name, biosphere)
+        return corpus.search(
+            list(queries),
+            score_cutoff=score_cutoff,
+            limit=limit,
+            blocks=blocks,
+            prefilter_limit=self.fuzzy_prefilter_limit,
+        )
+
+    def _invalidate_corpora(self, project_name: str, database_name: str) -> None:
+        """
+        Internal method.
+        Drops the fuzzy matching corpora of a database after activities were deleted from it.
+        """
+        for biosphere in (True, False):
+            self._corpora.pop((project_name, database_name, biosphere), None)
+
+    def _fuzzy_block(self, activity_details: dict):
+        """
+        Internal method.
+        Returns the (unit, locations) block fuzzy candidates of an activity are restricted to,
+        or None if blocking is disabled.
+
+        Parameters:
+        - activity_details (dict): A dictionary of activity details, see _extract_activity_details.
 
-    @lru_cache(maxsize=128)
-    def _find_closest_match(self, query, database, score_cutoff=70, biosphere=True):
+        Returns:
+        - tuple or None: (unit, locations) where locations is None if only the unit is blocked on.
+        """
+        if not self.block_by_unit:
+            return None
+        if not self.block_by_location:
+            return (activity_details["unit"], None)
+        location = activity_details["location"]
+        locations = (location, *self.location_parents.get(location, ()), "GLO")
+        return (activity_details["unit"], tuple(dict.fromkeys(locations)))
+
+    def _find_closest_match(
+        self,
+        query: str,
+        database_name: str,
+        score_cutoff=70,
+        biosphere=True,
+        block: tuple = None,
+    ):
         """
         Internal method.
         Finds the closest match to a query in a database using fuzzy matching.
@@ -228,48 +2054,30 @@ class ActivityProjectMigrator:
         Parameters:
         ----------
         - query (str): The query to be matched.
-        - database (Database object): The database to be searched.
+        - database_name (str): Name of the database to be searched in the current project.
         - score_cutoff (int): The minimum score for a match to be considered.
+        - block (tuple): Optional (unit, locations) restricting the candidates, see _fuzzy_block.
 
         Returns:
         -------
-        - list: A list of matching entries.
+        - list: A list of (key, score) tuples of the matching entries, best first, or None.
         """
-
-        # Pair each transformed entry with its original database entry
-        if biosphere:
-            choices = [
-                (f"{entry['name']} {entry['categories']}", entry) for entry in database
-            ]
-        else:
-            choices = [
-                (
-                    f"{entry['name']} {entry['location']} {entry['reference product']}",
-                    entry,
-                )
-                for entry in database
-            ]
-
-        # Perform fuzzy matching using the transformed strings
-        high_score_matches = process.extract(
-            query,
-            [choice[0] for choice in choices],
-            scorer=fuzz.token_sort_ratio,
+        corpus = self._get_corpus(database_name, biosphere)
+        matches = corpus.search(
+            [query],
+            score_cutoff=score_cutoff,
             limit=5,
-        )
-
-        # Filter out matches below the score cutoff and retrieve the original entries
-        filtered_matches = [
-            original
-            for match, score in high_score_matches
-            if score >= score_cutoff
-            for transformed, original in choices
-            if transformed == match
-        ]
-        return filtered_matches if filtered_matches else None
+            blocks=[block],
+            prefilter_limit=self.fuzzy_prefilter_limit,
+        )[0]
+        return matches if matches else None
 
     def create_activity_if_not_found(
-        self, old_activity_code: str, by_key: bool = False, verbose: bool = False
+        self,
+        old_activity_code: str,
+        by_key: bool = False,
+        biosphere_name: str = "biosphere3",
+        verbose: bool = False,
     ) -> tuple:
         """
         Creates a new activity in the new database if it doesn't exist.
@@ -278,6 +2086,7 @@ class ActivityProjectMigrator:
         Parameters:
         ----------
         - old_activity_code (str): Code of the activity in the old database.
+        - biosphere_name (str): Name of the biosphere database the biosphere exchanges are linked to.
 
         Returns:
         -------
@@ -288,36 +2097,526 @@ class ActivityProjectMigrator:
         # if migration_result[1]:
         #     return migration_result[0]['code']
 
+        # Never create the same activity twice, no matter if it was given by code or by key
+        old_key = self._old_key(old_activity_code, by_key)
+        if old_key in self.created:
+            if self.created[old_key] in self._unwritten:
+                self._run_worklist(biosphere_name=biosphere_name, verbose=verbose)
+            return (self.created[old_key], True)
+
         # Fetch the activity from the old database
-        bd.projects.set_current(self.old_project_name)
-        old_db = bd.Database(self.old_db_name)
+        self._set_project(self.old_project_name)
+        activity_details = self._extract_activity_details(
+            self._load_old_nodes([old_key])[old_key]
+        )
 
-        if by_key:
-            activity = bd.get_activity(old_activity_code)
-        else:
-            activity = old_db.get(old_activity_code)
+        # The activity and everything it needs that isn't in the new database is created
+        # by the worklist, see _run_worklist
+        self._set_project(self.new_project_name)
+        new_key = self._schedule_creation(old_key, activity_details)
+        self._run_worklist(biosphere_name=biosphere_name, verbose=verbose)
+        return (new_key, True)
+
+    def _schedule_creation(self, old_key: tuple, activity_details: dict) -> tuple:
+        """
+        Internal method.
+        Reserves the key of the activity created for old_key and adds old_key to the worklist.
+        The key is registered right away, so any reference to the old activity found before it's
+        written (including cyclic ones) resolves to it and it's only ever created once.
+
+        Parameters:
+        - old_key (tuple): Key of the activity in the old database.
+        - activity_details (dict): The details of the old activity, see _extract_activity_details.
+
+        Returns:
+        - tuple: The key the new activity will have.
+        """
+        new_key = (self.new_db_name, uuid.uuid4().hex)
+        self.created[old_key] = new_key
+        self._unwritten[new_key] = activity_details
+        self._log("created", old_key, new_key)
+        self._store(old_key, Resolution(new_key, "created", None))
+        # keep the exact match index in sync, otherwise the next lookup would miss the new activity
+        if self._exact_index is not None:
+            self._exact_index.setdefault(self._details_key(activity_details), new_key)
+            self._normalized_index.setdefault(
+                self._normalized_key(activity_details), new_key
+            )
+            self._location_index.setdefault(
+                self._product_key(activity_details), {}
+            ).setdefault(activity_details["location"], new_key)
+        # the fuzzy corpus is extended rather than rebuilt, it would otherwise be read again for every reservation
+        corpus = self._corpora.get((self.new_project_name, self.new_db_name, False))
+        if corpus is not None:
+            corpus.add(
+                f"{activity_details['name']} {activity_details['location']} {activity_details['reference product']}",
+                new_key,
+                unit=activity_details["unit"],
+                location=activity_details["location"],
+            )
+        self._worklist.append(old_key)
+        return new_key
+
+    def _run_worklist(
+        self, biosphere_name: str = "biosphere3", verbose: bool = False
+    ) -> None:
+        """
+        Internal method.
+        Creates every activity on the worklist and everything they need that isn't in the new database.
+        Nothing is written before the plan is complete, see _plan_creation: the activities are then
+        created in dependency order with their exchanges read in bulk, and written in batches.
+        Batches are only written between activities, and a checkpoint is saved after each one.
+        If anything fails, the buffered rows are dropped and the activities that aren't written yet
+        go back on the worklist with their reserved keys, and a checkpoint is saved, so they are created
+        by the next run or by resume(). Batches written before the failure stay, and may point to them.
+        """
+        with self._buffered_writes():
+            while self._worklist:
+                roots, self._worklist = self._worklist, []
+                order = None
+                written = 0
+                try:
+                    components = self._plan_creation(roots, verbose=verbose)
+                    order = [
+                        old_key for component in components for old_key in component
+                    ]
+
+                    self._set_project(self.old_project_name)
+                    exchanges = self._collect_exchange_details(order)
+
+                    self._set_project(self.new_project_name)
+                    for position, old_key in enumerate(order):
+                        new_key = self.created[old_key]
+                        new_act = dict(
+                            self._extract_activity_details(self._old_nodes[old_key]),
+                            database=new_key[0],
+                            code=new_key[1],
+                            auto_generated=True,
+                        )
+                        self._writer.add_activity(new_act)
+                        self._handle_exchanges(
+                            new_act,
+                            exchanges[old_key],
+                            biosphere_name=biosphere_name,
+                            verbose=verbose,
+                        )
+                        if len(self._writer) >= BULK_FLUSH_SIZE or (
+                            self.checkpoint_path is not None
+                            and time.monotonic() - self._last_checkpoint
+                            > CHECKPOINT_INTERVAL
+                        ):
+                            self.flush_writes()
+                            written = position + 1
+                except BaseException:
+                    self._writer = _BulkWriter()
+                    unwritten = roots if order is None else order[written:]
+                    self._worklist = unwritten + self._worklist
+                    # so resume() works even if nothing was written yet
+                    self._checkpoint()
+                    raise
+
+    def _log(self, *entry) -> None:
+        """
+        Internal method.
+        Queues a change for the checkpoint, if enabled: ("result", old key, new key, kind, score),
+        ("created", old key, new key) when a key is reserved, ("written", new key) and ("forgotten", new keys).
+        """
+        if self.checkpoint_path is not None:
+            self._checkpoint_entries.append(entry)
+
+    def _checkpoint(self) -> None:
+        """
+        Internal method.
+        Appends the changes queued since the last checkpoint to self.checkpoint_path, if set, one json line each,
+        so saving a checkpoint doesn't get slower as the run goes on. The first checkpoint of a migrator starts
+        a new file, unless it resumed from it. An interrupted append only damages the last line, which resume() skips.
+        Only called right after a write to the new database, or with nothing buffered,
+        so the checkpoint always matches what is in the new database.
+        """
+        if self.checkpoint_path is None:
+            return
+        mode = "a"
+        if not self._checkpoint_started:
+            mode = "w"
+            self._checkpoint_entries.insert(
+                0,
+                (
+                    "scope",
+                    [
+                        self.old_project_name,
+                        self.old_db_name,
+                        self.new_project_name,
+                        self.new_db_name,
+                    ],
+                ),
+            )
+            self._checkpoint_started = True
+        if self._checkpoint_entries:
+            with open(self.checkpoint_path, mode) as f:
+                f.writelines(
+                    json.dumps(entry) + "\n" for entry in self._checkpoint_entries
+                )
+            self._checkpoint_entries = []
+        self._last_checkpoint = time.monotonic()
+
+    def resume(self, biosphere_name: str = "biosphere3", verbose: bool = False) -> dict:
+        """
+        Continues an interrupted run from the last checkpoint, in this or in a new migrator.
+        The cached results and created activities are restored, so nothing is matched or created twice,
+        and the activities that were planned but not written yet are created with the keys they were given,
+        which is what the activities already written point to.
+
+        Parameters:
+        ----------
+        - biosphere_name (str): Name of the biosphere database, same as in the interrupted run.
+        - verbose (bool): If True, prints what is being done.
 
-        if activity is None:
+        Returns:
+        -------
+        - dict: A dictionary mapping the old keys of the activities created by the resumed run to their new keys.
+        """
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            raise ValueError(f"No checkpoint found at '{self.checkpoint_path}'")
+        entries = []
+        with open(self.checkpoint_path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line of an interrupted append
+                    break
+        scope = [
+            self.old_project_name,
+            self.old_db_name,
+            self.new_project_name,
+            self.new_db_name,
+        ]
+        if not entries or entries[0] != ["scope", scope]:
             raise ValueError(
-                f"Activity code '{old_activity_code}' doesn't exist in the old database '{self.old_db_name}'"
+                f"The checkpoint at '{self.checkpoint_path}' is for {entries[0][1] if entries else None}, not for {scope}"
+            )
+
+        # replay the changes in order
+        self.cache.clear()
+        self.created = {}
+        written = set()
+        forgotten = set()
+        for kind, *values in entries[1:]:
+            if kind == "result":
+                old_key, new_key, resolution_kind, score = values
+                self.cache[tuple(old_key)] = Resolution(
+                    tuple(new_key) if new_key is not None else None,
+                    resolution_kind,
+                    score,
+                )
+            elif kind == "created":
+                self.created[tuple(values[0])] = tuple(values[1])
+            elif kind == "written":
+                written.add(tuple(values[0]))
+            elif kind == "forgotten":
+                forgotten.update(tuple(new_key) for new_key in values[0])
+        self.created = {
+            old_key: new_key
+            for old_key, new_key in self.created.items()
+            if new_key not in forgotten
+        }
+        for old_key in [
+            old_key
+            for old_key, resolution in self.cache.items()
+            if resolution.new_key in forgotten
+        ]:
+            self.cache.pop(old_key)
+        # later checkpoints are appended to the same file
+        self._checkpoint_entries = []
+        self._checkpoint_started = True
+        self._writer = _BulkWriter()
+        self._worklist = [
+            old_key
+            for old_key, new_key in self.created.items()
+            if new_key not in written
+        ]
+        self._set_project(self.old_project_name)
+        nodes = self._load_old_nodes(self._worklist)
+        self._unwritten = {
+            self.created[old_key]: self._extract_activity_details(nodes[old_key])
+            for old_key in self._worklist
+        }
+        self._awaiting_write = {}
+        if self._persistent is not None:
+            self._awaiting_write = {
+                self.created[old_key]: [
+                    (old_key, Resolution(self.created[old_key], "created", None))
+                ]
+                for old_key in self._worklist
+            }
+        # the new database changed since the indexes were built
+        self._exact_index = self._normalized_index = self._location_index = None
+        self._invalidate_corpora(self.new_project_name, self.new_db_name)
+
+        resumed = list(self._worklist)
+        if verbose:
+            print(
+                f"Resuming from '{self.checkpoint_path}': {len(self.created)} activities created, {len(resumed)} to go"
+            )
+        self._run_worklist(biosphere_name=biosphere_name, verbose=verbose)
+        self.save_cache()
+        return {old_key: self.created[old_key] for old_key in resumed}
+
+    def rollback(self, verbose: bool = False) -> int:
+        """
+        Deletes every activity created by this migrator (see self.created), with their exchanges,
+        in a single transaction. Results pointing to them are dropped from the cache, so they are matched again.
+
+        Parameters:
+        ----------
+        - verbose (bool): If True, prints what is being done.
+
+        Returns:
+        -------
+        - int: The number of deleted activities.
+        """
+        # activities buffered or planned but not written yet are simply dropped
+        self._writer = _BulkWriter()
+        self._worklist = []
+        new_keys = list(self.created.values())
+        self._set_project(self.new_project_name)
+        deleted = self._delete_activities(new_keys)
+        self._forget(new_keys)
+        if verbose:
+            print(f"Deleted {deleted} created activities")
+        return deleted
+
+    def delete_auto_generated(
+        self, database_name: str = None, verbose: bool = False
+    ) -> int:
+        """
+        Deletes every activity with the auto_generated attribute from a database of the new project,
+        including the ones created by earlier sessions, with their exchanges, in a single transaction.
+        The attribute is only stored in the activity data, so the activities of the database are read
+        with one query on its (indexed) name and filtered in memory, without loading Activity objects.
+
+        Parameters:
+        ----------
+        - database_name (str): Name of the database, the new database by default.
+        - verbose (bool): If True, prints what is being done.
+
+        Returns:
+        -------
+        - int: The number of deleted activities.
+        """
+        database_name = database_name or self.new_db_name
+        self._set_project(self.new_project_name)
+        new_keys = [
+            (database_name, code)
+            for code, data in ActivityDataset.select(
+                ActivityDataset.code, ActivityDataset.data
+            )
+            .where(ActivityDataset.database == database_name)
+            .tuples()
+            if data.get("auto_generated")
+        ]
+        # activities planned but not written yet are dropped as well
+        unwritten = [self.created[old_key] for old_key in self._worklist]
+        self._writer = _BulkWriter()
+        self._worklist = []
+        deleted = self._delete_activities(new_keys)
+        self._forget(new_keys + unwritten)
+        if verbose:
+            print(f"Deleted {deleted} auto generated activities from '{database_name}'")
+        return deleted
+
+    def _delete_activities(self, keys: list, inbound: bool = True) -> int:
+        """
+        Internal method.
+        Deletes activities of the current project, the exchanges they produce and the exchanges pointing to them
+        (like Activity.delete does) with a few bulk queries in one transaction,
+        then updates the search index and database metadata once per database.
+
+        Parameters:
+        - keys (list): Keys of the activities to delete.
+        - inbound (bool): If False, the exchanges pointing to them are kept, used when they are written again.
+
+        Returns:
+        - int: The number of deleted activities.
+        """
+        codes_by_database = {}
+        for database, code in keys:
+            codes_by_database.setdefault(database, []).append(code)
+        deleted = 0
+        with sqlite3_lci_db.atomic():
+            for database, codes in codes_by_database.items():
+                for start in range(0, len(codes), QUERY_CHUNK_SIZE):
+                    chunk = codes[start : start + QUERY_CHUNK_SIZE]
+                    ExchangeDataset.delete().where(
+                        (ExchangeDataset.output_database == database)
+                        & (ExchangeDataset.output_code << chunk)
+                    ).execute()
+                    if inbound:
+                        ExchangeDataset.delete().where(
+                            (ExchangeDataset.input_database == database)
+                            & (ExchangeDataset.input_code << chunk)
+                        ).execute()
+                    deleted += (
+                        ActivityDataset.delete()
+                        .where(
+                            (ActivityDataset.database == database)
+                            & (ActivityDataset.code << chunk)
+                        )
+                        .execute()
+                    )
+        for database, codes in codes_by_database.items():
+            bd.databases.set_dirty(database)
+            if bd.databases[database].get("searchable", True):
+                index = IndexManager(bd.Database(database).filename)
+                with index.db.connection_context():
+                    with index.db.bind_ctx(SEARCH_MODELS):
+                        for model in SEARCH_MODELS:
+                            for start in range(0, len(codes), QUERY_CHUNK_SIZE):
+                                model.delete().where(
+                                    (model.database == database)
+                                    & (
+                                        model.code
+                                        << codes[start : start + QUERY_CHUNK_SIZE]
+                                    )
+                                ).execute()
+        if deleted:
+            self._own_writes = True
+        return deleted
+
+    def _forget(self, new_keys: list) -> None:
+        """
+        Internal method.
+        Drops everything the migrator knows about deleted activities of the new project: the created activities,
+        cached results pointing to them (in memory and persistent) and the indexes of the new database.
+        """
+        new_keys = set(new_keys)
+        self._log("forgotten", list(new_keys))
+        self.created = {
+            old_key: new_key
+            for old_key, new_key in self.created.items()
+            if new_key not in new_keys
+        }
+        for old_key in [
+            old_key
+            for old_key, resolution in self.cache.items()
+            if resolution.new_key in new_keys
+        ]:
+            self.cache.pop(old_key)
+        for new_key in new_keys:
+            self._unwritten.pop(new_key, None)
+            self._awaiting_write.pop(new_key, None)
+        if self._persistent is not None:
+            self._persistent.discard(new_keys)
+        self._exact_index = self._normalized_index = self._location_index = None
+        self._invalidate_corpora(self.new_project_name, self.new_db_name)
+        self.save_cache()
+
+    def _plan_creation(
+        self, roots: list, dry_run: bool = False, verbose: bool = False
+    ) -> list[list[tuple]]:
+        """
+        Internal method.
+        Plans the creation of the root activities without writing anything.
+        The dependency graph of the old databases is read with one exchange query per database. The plan then grows
+        one level at a time: the inputs of the activities of the level that aren't cached yet are read in bulk in the
+        old project, then resolved in the new project, and the unmatched ones are scheduled and make the next level.
+        Inputs with a match are never expanded, so only the activities to create and their direct inputs are read.
+
+        Parameters:
+        - roots (list): Old keys of the activities to create, already scheduled unless dry_run is True.
+        - dry_run (bool): If True, the unmatched inputs are only added to the plan, not scheduled,
+            so nothing changes in the new project or in self.created.
+
+        Returns:
+        - list of lists: Strongly connected components of the activities to create, in creation order,
+            i.e. each component comes after the components it depends on. Components of more than
+            one activity are cycles.
+        """
+        to_create = list(roots)
+        planned = set(roots)
+        level = list(roots)
+        while level:
+            self._set_project(self.old_project_name)
+            inputs = {
+                input_key: self._lookup(input_key)
+                for old_key in level
+                for input_key in self._dependency_graph(old_key[0]).get(old_key, ())
+                if input_key not in planned
+            }
+            # the details of the level itself are needed to write it
+            self._load_old_nodes(
+                level
+                + [
+                    input_key
+                    for input_key, resolution in inputs.items()
+                    if resolution is None or resolution.new_key is None
+                ]
             )
 
-        # Extract activity and exchange details
-        activity_details = self._extract_activity_details(activity)
-        exchange_details_list = self._collect_exchange_details(activity)
+            self._set_project(self.new_project_name)
+            level = []
+            for input_key, resolution in inputs.items():
+                if resolution is None:
+                    resolution = self._resolve(
+                        input_key,
+                        self._extract_activity_details(self._old_nodes[input_key]),
+                        verbose=verbose,
+                    )
+                if resolution.new_key is None:
+                    if not dry_run:
+                        self._schedule_creation(
+                            input_key,
+                            self._extract_activity_details(self._old_nodes[input_key]),
+                        )
+                    planned.add(input_key)
+                    to_create.append(input_key)
+                    level.append(input_key)
+        if not dry_run:
+            # _schedule_creation put them on the worklist again, they are all handled here
+            self._worklist = []
+
+        components = _strongly_connected_components(
+            to_create,
+            lambda old_key: self._dependency_graph(old_key[0]).get(old_key, ()),
+        )
+        if verbose:
+            cycles = sum(1 for component in components if len(component) > 1)
+            print(
+                f"Creating {len(to_create)} activities for {len(roots)} requested, {cycles} cycles"
+            )
+        return components
 
-        # Generate a unique code for the new activity and create it in the new database
-        unique_code = uuid.uuid4().hex
-        bd.projects.set_current(self.new_project_name)
-        new_db = bd.Database(self.new_db_name)
-        new_act = new_db.new_activity(code=unique_code, **activity_details)
-        new_act["auto_generated"] = True
-        new_act.save()
+    def _dependency_graph(self, database_name: str) -> dict:
+        """
+        Internal method.
+        Returns the technosphere inputs of every activity of an old database, read with a single query
+        the first time and kept for later calls. The first call for a database expects the old project
+        to be the current project.
 
-        # Handle exchanges for the new activity
-        self._handle_exchanges(new_act, exchange_details_list, verbose=verbose)
+        Parameters:
+        - database_name (str): Name of a database in the old project.
 
-        return (new_act.key, True)
+        Returns:
+        - dict: A dictionary mapping the key of each activity to the list of keys of its technosphere inputs.
+        """
+        if database_name not in self._dependency_graphs:
+            graph = {}
+            for output_code, input_database, input_code, kind in (
+                ExchangeDataset.select(
+                    ExchangeDataset.output_code,
+                    ExchangeDataset.input_database,
+                    ExchangeDataset.input_code,
+                    ExchangeDataset.type,
+                )
+                .where(ExchangeDataset.output_database == database_name)
+                .tuples()
+            ):
+                if kind not in ("production", "biosphere"):
+                    graph.setdefault((database_name, output_code), []).append(
+                        (input_database, input_code)
+                    )
+            self._dependency_graphs[database_name] = graph
+        return self._dependency_graphs[database_name]
 
     def _extract_activity_details(self, activity: bd.Node) -> dict:
         """
@@ -337,67 +2636,311 @@ class ActivityProjectMigrator:
             "reference product": activity.get("reference product"),
         }
 
-    def _collect_exchange_details(self, activity) -> list[dict]:
-        """
-        Internal method.
-        Collects details of exchanges associated with an activity, stopping the collection
-        when a duplicate exchange is detected.
-
-        Parameters:
-        - activity (Activity object): The activity from which exchanges are to be collected.
-
-        Returns:
-        - list of dicts: A list of dictionaries, each containing details of an exchange.
-        """
-        exchange_details_list = []
-        seen_exchanges = set()
-
-        for exc in activity.exchanges():
-            exchange_key = (exc.input.key, exc.amount, exc.unit)
-            if exchange_key in seen_exchanges:
-                # TODO find a better way to deal with this,
-                # i do this because sometimes it just loops forever
-                # and i don't know why
-                # maybe it's because of the way the exchanges are stored in the database
-                # a possible solution is to use the exchange key as the key in the cache or
-                # to use the exchange key as the key in the cache and the value as the activity code
-                # the problem with this is that if for some reason there are duplicated exchanges on purpose
-                # which means the creation process will miss some exchanges,
-                # but for all the activities i've seen they have no duplicated exchanges so we are mostly safe.
-                break  # Stop processing further exchanges if a duplicate is found
-            seen_exchanges.add(exchange_key)
-            # categories = target['categories']
-            exchange_details = {
-                "input": exc.input.key,
-                "amount": exc.amount,
-                "unit": exc.unit,
-                "type": exc["type"],
-                # "uncertainty type": exc.uncertainty.get("uncertainty type"),
-                # "loc": exc.get("loc", np.nan),
-                # "scale": exc.get("scale", np.nan),
-                # "negative": exc.get("negative", np.nan),
-                # "minimum": exc.get("minimum", np.nan),
-                # "maximum": exc.get("maximum", np.nan),
-            }
-            # So why do this and not put the name and the categories in the exchange details?
-            # Because for some reason sometimes it does not let me access them from the exchange object
-            # So i have to get the activity object from the db and get the name and categories from there
-            # TODO look into why this happens and a better fix
-            target = bd.get_activity(exc.input.key)
-            name = target["name"]
-            exchange_details.update({"name": name})
-            if exchange_details["type"] == "biosphere":
-                categories = target["categories"]
-                exchange_details.update({"categories": categories})
+    def _details_key(self, activity_details: dict) -> tuple:
+        """
+        Internal method.
+        Turns the output of _extract_activity_details into a hashable key for the exact match index.
+
+        Parameters:
+        - activity_details (dict): A dictionary of activity details.
+
+        Returns:
+        - tuple: (name, location, unit, reference product)
+        """
+        return (
+            activity_details["name"],
+            activity_details["location"],
+            activity_details["unit"],
+            activity_details["reference product"],
+        )
+
+    def _normalized_key(self, activity_details: dict) -> tuple:
+        """
+        Internal method.
+        Same as _details_key, with the name and reference product normalized, see _normalize.
+        This catches renames like "iron (III) chloride" to "iron(III) chloride" without fuzzy matching.
+        """
+        return (
+            _normalize(activity_details["name"]),
+            activity_details["location"],
+            activity_details["unit"],
+            _normalize(activity_details["reference product"]),
+        )
+
+    def _product_key(self, activity_details: dict) -> tuple:
+        """
+        Internal method.
+        Same as _normalized_key without the location, the key of the location fallback index.
+        """
+        return (
+            _normalize(activity_details["name"]),
+            activity_details["unit"],
+            _normalize(activity_details["reference product"]),
+        )
+
+    def _get_exact_index(self) -> dict:
+        """
+        Internal method.
+        Returns the index used for exact matching in the new database, building it on first use.
+        The index maps (name, location, unit, reference product) to the key of the first activity
+        with these details, so lookups don't have to scan the whole database.
+        The normalized match and location fallback indexes are built in the same pass.
+        Expects the new project to be the current project.
+
+        Returns:
+        - dict: A dictionary mapping activity details tuples to activity keys.
+        """
+        if self._exact_index is None:
+            index = {}
+            normalized_index = {}
+            location_index = {}
+            for new_activity in bd.Database(self.new_db_name):
+                activity_details = self._extract_activity_details(new_activity)
+                # setdefault keeps the first match, same as the old linear scan did
+                index.setdefault(self._details_key(activity_details), new_activity.key)
+                normalized_index.setdefault(
+                    self._normalized_key(activity_details), new_activity.key
+                )
+                location_index.setdefault(
+                    self._product_key(activity_details), {}
+                ).setdefault(activity_details["location"], new_activity.key)
+            self._exact_index = index
+            self._normalized_index = normalized_index
+            self._location_index = location_index
+        return self._exact_index
+
+    def _correspondence_lookup(self, old_key: tuple):
+        """
+        Internal method.
+        Looks an activity of the old database up in the loaded correspondence tables, see load_correspondence.
 
-            exchange_details_list.append(exchange_details)
+        Returns:
+        - Resolution: The match with kind "correspondence", or None if the tables have none.
+        """
+        if old_key[0] != self.old_db_name:
+            return None
+        new_key = self._correspondence.get(old_key[1])
+        if new_key is None:
+            return None
+        return Resolution(new_key, "correspondence", None)
+
+    def _index_lookup(self, activity_details: dict):
+        """
+        Internal method.
+        Looks activity details up in the exact match index, then in the normalized match index,
+        then, if location_fallback is on, in the location fallback index.
+        Expects the new project to be the current project.
+
+        Returns:
+        - Resolution: The match with kind "exact", "normalized" or "location", or None if no index has one.
+        """
+        new_key = self._get_exact_index().get(self._details_key(activity_details))
+        if new_key is not None:
+            return Resolution(new_key, "exact", None)
+        new_key = self._normalized_index.get(self._normalized_key(activity_details))
+        if new_key is not None:
+            return Resolution(new_key, "normalized", None)
+        if not self.location_fallback:
+            return None
+        # same activity, other location, e.g. a region that was split or GLO replaced by RoW
+        locations = self._location_index.get(self._product_key(activity_details), {})
+        for location in self._location_preferences(activity_details["location"]):
+            new_key = locations.get(location)
+            if new_key is not None:
+                return Resolution(new_key, "location", None)
+        return None
+
+    def _location_preferences(self, location: str) -> tuple:
+        """
+        Internal method.
+        Returns the locations to fall back to, in order, when an activity isn't found in its own location,
+        see location_fallbacks in __init__.
+        """
+        if location in self.location_fallbacks:
+            return tuple(self.location_fallbacks[location])
+        preferences = (*self.location_parents.get(location, ()), "GLO", "RoW")
+        return tuple(other for other in dict.fromkeys(preferences) if other != location)
+
+    def _hashable(self, value):
+        """
+        Internal method.
+        Converts lists (e.g. categories coming from json) to tuples so they can be used in index keys.
+        """
+        if isinstance(value, list):
+            return tuple(self._hashable(item) for item in value)
+        return value
+
+    def _index_value(self, field: str, value):
+        """
+        Internal method.
+        Prepares a field value for the biosphere indexes: hashable, and CAS numbers without leading zeros,
+        since some biosphere versions write "000124-38-9" and others "124-38-9".
+        "normalized name" is the name run through _normalize, so synonyms don't have to match it exactly.
+        """
+        if field == "CAS number" and isinstance(value, str):
+            return value.strip().lstrip("0")
+        if field == "normalized name":
+            return _normalize(value)
+        return self._hashable(value)
+
+    def _get_biosphere_index(
+        self, biosphere_name: str, fields: tuple, unique: bool = False
+    ) -> dict:
+        """
+        Internal method.
+        Returns an index of the biosphere database keyed on the values of the given fields,
+        building it on first use. Each index is only built once per migrator and biosphere name.
+        Expects the new project to be the current project.
+
+        Parameters:
+        - biosphere_name (str): Name of the biosphere database.
+        - fields (tuple): The names of the fields used in the index key, e.g. ("categories", "name", "unit").
+        - unique (bool): If True, values shared by several flows are left out of the index,
+            instead of pointing to the first of them.
+
+        Returns:
+        - dict: A dictionary mapping field values to the key of the first flow with these values.
+        """
+        indexes = self._biosphere_indexes.setdefault(biosphere_name, {})
+        if (fields, unique) not in indexes:
+            if biosphere_name not in self._biosphere_flows:
+                # read the biosphere only once, other field combinations are built from this
+                self._biosphere_flows[biosphere_name] = [
+                    (flow.key, dict(flow)) for flow in bd.Database(biosphere_name)
+                ]
+            index = {}
+            shared = set()
+            for key, data in self._biosphere_flows[biosphere_name]:
+                values = tuple(
+                    self._index_value(
+                        field, data.get("name" if field == "normalized name" else field)
+                    )
+                    for field in fields
+                )
+                if values in index:
+                    shared.add(values)
+                # setdefault keeps the first match, same as the old list comprehension did
+                index.setdefault(values, key)
+            if unique:
+                for values in shared:
+                    del index[values]
+            indexes[(fields, unique)] = index
+        return indexes[(fields, unique)]
+
+    def _load_old_nodes(self, keys: list) -> dict:
+        """
+        Internal method.
+        Loads the fields used for matching (name, location, unit, reference product, categories)
+        of many nodes with one query per database, and keeps them in memory for later calls.
+        Expects the old project to be the current project.
+
+        Parameters:
+        - keys (list): Keys of nodes in the old project.
+
+        Returns:
+        - dict: A dictionary mapping each key to a dictionary of its fields.
+        """
+        missing = {}
+        for database, code in dict.fromkeys(keys):
+            if (database, code) not in self._old_nodes:
+                missing.setdefault(database, []).append(code)
+        for database, codes in missing.items():
+            for start in range(0, len(codes), QUERY_CHUNK_SIZE):
+                for dataset in ActivityDataset.select(
+                    ActivityDataset.code, ActivityDataset.data
+                ).where(
+                    (ActivityDataset.database == database)
+                    & (ActivityDataset.code << codes[start : start + QUERY_CHUNK_SIZE])
+                ):
+                    self._old_nodes[(database, dataset.code)] = {
+                        field: dataset.data.get(field) for field in NODE_FIELDS
+                    }
+        not_found = [key for key in keys if key not in self._old_nodes]
+        if not_found:
+            raise ValueError(
+                f"Activities {not_found} don't exist in the old project '{self.old_project_name}'"
+            )
+        return {key: self._old_nodes[key] for key in keys}
+
+    def _collect_exchange_details(self, old_keys: list) -> dict:
+        """
+        Internal method.
+        Collects details of exchanges associated with many activities, with one query per database and chunk.
+        Expects the old project to be the current project.
+
+        Parameters:
+        - old_keys (list): Keys of the activities from which exchanges are to be collected.
+
+        Returns:
+        - dict: A dictionary mapping each key to a list of dictionaries, each containing details of an exchange.
+        """
+        exchanges = {old_key: [] for old_key in old_keys}
+        codes_by_database = {}
+        for database, code in old_keys:
+            codes_by_database.setdefault(database, []).append(code)
+        for database, codes in codes_by_database.items():
+            for start in range(0, len(codes), QUERY_CHUNK_SIZE):
+                for output_code, data in (
+                    ExchangeDataset.select(
+                        ExchangeDataset.output_code, ExchangeDataset.data
+                    )
+                    .where(
+                        (ExchangeDataset.output_database == database)
+                        & (
+                            ExchangeDataset.output_code
+                            << codes[start : start + QUERY_CHUNK_SIZE]
+                        )
+                    )
+                    .order_by(ExchangeDataset.id)
+                    .tuples()
+                ):
+                    exchanges[(database, output_code)].append(data)
+
+        # the input nodes are read in one go as well, most of them were already loaded by the planner
+        nodes = self._load_old_nodes(
+            [tuple(exc["input"]) for excs in exchanges.values() for exc in excs]
+        )
+
+        details = {}
+        for old_key, excs in exchanges.items():
+            exchange_details_list = []
+            for exc in excs:
+                input_key = tuple(exc["input"])
+                target = nodes[input_key]
+                # categories = target['categories']
+                exchange_details = {
+                    "input": input_key,
+                    "amount": exc["amount"],
+                    "unit": target["unit"],
+                    "type": exc["type"],
+                    # "uncertainty type": exc.uncertainty.get("uncertainty type"),
+                    # "loc": exc.get("loc", np.nan),
+                    # "scale": exc.get("scale", np.nan),
+                    # "negative": exc.get("negative", np.nan),
+                    # "minimum": exc.get("minimum", np.nan),
+                    # "maximum": exc.get("maximum", np.nan),
+                }
+                # So why do this and not put the name and the categories in the exchange details?
+                # Because for some reason sometimes it does not let me access them from the exchange object
+                # So i have to get the activity object from the db and get the name and categories from there
+                name = target["name"]
+                exchange_details.update({"name": name})
+                if exchange_details["type"] == "biosphere":
+                    categories = target["categories"]
+                    exchange_details.update({"categories": categories})
+                    if target["CAS number"]:
+                        exchange_details.update({"CAS number": target["CAS number"]})
 
-        return exchange_details_list
+                exchange_details_list.append(exchange_details)
+            details[old_key] = exchange_details_list
+
+        return details
 
     def _handle_exchanges(
         self,
-        new_act: bd.Node,
+        new_act: dict,
         exchange_details_list: list[dict],
+        biosphere_name: str = "biosphere3",
         verbose: bool = False,
     ) -> None:
         """
@@ -406,8 +2949,9 @@ class ActivityProjectMigrator:
 
         Parameters:
         ----------
-        - new_act (Activity object): The newly created activity in the new database.
+        - new_act (dict): The data of the newly created activity, buffered in self._writer.
         - exchange_details_list (list of dicts): List of exchange details to be added to the new activity.
+        - biosphere_name (str): Name of the biosphere database the biosphere exchanges are linked to.
 
         Returns:
         -------
@@ -425,9 +2969,16 @@ class ActivityProjectMigrator:
         #     if verbose:
         #         print(f"Activity: {new_act.key} and its exchange details are in the cache, skipping")
         #     return
-        new_act.new_exchange(
-            input=new_act, amount=1, type="production", unit=new_act["unit"]
-        ).save()
+        new_key = (new_act["database"], new_act["code"])
+        self._writer.add_exchange(
+            {
+                "input": new_key,
+                "output": new_key,
+                "amount": 1,
+                "type": "production",
+                "unit": new_act["unit"],
+            }
+        )
 
         for exchange_details in exchange_details_list:
             if verbose:
@@ -436,7 +2987,7 @@ class ActivityProjectMigrator:
                 if verbose:
                     print("Handling biosphere exchange")
                 migrated_input = self._handle_biosphere_migration(
-                    exchange_details, verbose=verbose
+                    exchange_details, biosphere_name=biosphere_name, verbose=verbose
                 )
             elif exchange_details["type"] == "production":
                 if verbose:
@@ -444,26 +2995,35 @@ class ActivityProjectMigrator:
                 continue  # Skip production exchanges
             else:
                 # Migrate the activity of each exchange
-                migrated_input = self.migrate_activity(
-                    exchange_details["input"], return_code_only=False, by_key=True
-                )
-
-                exchange_details["input"] = migrated_input[0]
+                # the details were read together with the exchanges, so this stays in the new project
+                # unless the activity has to be created
+                old_key = exchange_details["input"]
+                resolution = self._lookup(old_key)
+                if resolution is None:
+                    resolution = self._resolve(
+                        old_key,
+                        self._extract_activity_details(self._old_nodes[old_key]),
+                        verbose=verbose,
+                    )
+                migrated_input = (resolution.new_key, resolution.new_key is not None)
                 if verbose:
                     print("Handling technosphere exchange")
                     print(f"Migrated input: {migrated_input}")
-            # if the exchange is not found in the new database
-            if not migrated_input[1]:
-                # create the activity of the exchange in the new database if it doesn't exist
-                nested_technosphere_exchange = self.create_activity_if_not_found(
-                    exchange_details["input"], by_key=True, verbose=verbose
-                )
-                # grab the key of the newly created activity
-                exchange_details["input"] = nested_technosphere_exchange[0]
-                if verbose:
-                    print(
-                        f"The activity the exchanged is pointing at was not found, Created the activity: {nested_technosphere_exchange}"
+                if not migrated_input[1]:
+                    # create the activity of the exchange in the new database if it doesn't exist
+                    # it's only put on the worklist, its key can be used right away
+                    migrated_input = (
+                        self._schedule_creation(
+                            old_key,
+                            self._extract_activity_details(self._old_nodes[old_key]),
+                        ),
+                        True,
                     )
+                    if verbose:
+                        print(
+                            f"The activity the exchanged is pointing at was not found, Created the activity: {migrated_input}"
+                        )
+            exchange_details["input"] = migrated_input[0]
 
             # Add the exchanges to the new activity
-            new_act.new_exchange(**exchange_details).save()
+            self._writer.add_exchange(dict(exchange_details, output=new_key))
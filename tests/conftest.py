@@ -0,0 +1,196 @@
+import os
+import sys
+import tempfile
+
+# bw2data reads its data directory when it's imported, so it has to be set first
+os.environ["BRIGHTWAY2_DIR"] = tempfile.mkdtemp()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bw2data as bd
+import pytest
+
+
+def _activity(code, name, location, unit, product, exchanges, db):
+    return {
+        "name": name,
+        "location": location,
+        "unit": unit,
+        "reference product": product,
+        "type": "process",
+        "exchanges": [
+            {"input": (db, code), "amount": 1, "type": "production", "unit": unit}
+        ]
+        + exchanges,
+    }
+
+
+def _biosphere(renamed_pm10):
+    flows = {
+        ("biosphere3", "co2"): {
+            "name": "Carbon dioxide, fossil",
+            "categories": ("air",),
+            "unit": "kilogram",
+            "type": "emission",
+            "CAS number": "000124-38-9",
+        },
+        ("biosphere3", "pm10new" if renamed_pm10 else "pm10"): {
+            "name": (
+                "Particulate matter, > 10 um"
+                if renamed_pm10
+                else "Particulates, > 10 um"
+            ),
+            "categories": ("air",),
+            "unit": "kilogram",
+            "type": "emission",
+        },
+        ("biosphere3", "water"): {
+            "name": "Water",
+            "categories": ("water",),
+            "unit": "cubic meter",
+            "type": "emission",
+        },
+    }
+    if not renamed_pm10:
+        # only in the old biosphere, activities emitting it can't be created until it's added to the new one
+        flows[("biosphere3", "xenon")] = {
+            "name": "Xenon-135",
+            "categories": ("air",),
+            "unit": "kilogram",
+            "type": "emission",
+        }
+    return flows
+
+
+@pytest.fixture
+def projects(request):
+    """
+    An old and a new project, named after the test. The old database has a matched activity (a),
+    an exact match (b), two activities missing in the new database that use each other (c and d)
+    one only found in another location (e), and two identical activities emitting a flow that is missing
+    in the new biosphere (g and h). The old project also has a foreground database whose activity X uses g and b.
+    """
+    old_project, new_project = f"old {request.node.name}", f"new {request.node.name}"
+    old = {
+        ("ei_old", "a"): _activity(
+            "a",
+            "iron (III) chloride production, product in 40% solution state",
+            "RER",
+            "kilogram",
+            "iron (III) chloride",
+            [
+                {"input": ("ei_old", "b"), "amount": 2, "type": "technosphere"},
+                {"input": ("biosphere3", "co2"), "amount": 0.5, "type": "biosphere"},
+                {"input": ("biosphere3", "pm10"), "amount": 0.1, "type": "biosphere"},
+            ],
+            "ei_old",
+        ),
+        ("ei_old", "b"): _activity(
+            "b",
+            "steel production",
+            "GLO",
+            "kilogram",
+            "steel",
+            [{"input": ("ei_old", "c"), "amount": 3, "type": "technosphere"}],
+            "ei_old",
+        ),
+        ("ei_old", "c"): _activity(
+            "c",
+            "unobtainium production",
+            "CH",
+            "kilogram",
+            "unobtainium",
+            [
+                {"input": ("ei_old", "d"), "amount": 1, "type": "technosphere"},
+                {"input": ("biosphere3", "water"), "amount": 1, "type": "biosphere"},
+            ],
+            "ei_old",
+        ),
+        ("ei_old", "d"): _activity(
+            "d",
+            "weird loop production",
+            "CH",
+            "kilogram",
+            "weird",
+            [{"input": ("ei_old", "c"), "amount": 0.1, "type": "technosphere"}],
+            "ei_old",
+        ),
+        ("ei_old", "e"): _activity(
+            "e",
+            "electricity production",
+            "GLO",
+            "kilowatt hour",
+            "electricity",
+            [],
+            "ei_old",
+        ),
+        ("ei_old", "g"): _activity(
+            "g",
+            "xenon production",
+            "CH",
+            "kilogram",
+            "xenon",
+            [{"input": ("biosphere3", "xenon"), "amount": 1, "type": "biosphere"}],
+            "ei_old",
+        ),
+        ("ei_old", "h"): _activity(
+            "h", "xenon production", "CH", "kilogram", "xenon", [], "ei_old"
+        ),
+    }
+    new = {
+        ("ei_new", "A"): _activity(
+            "A",
+            "iron(III) chloride production, product in 40% solution state",
+            "RER",
+            "kilogram",
+            "iron(III) chloride",
+            [],
+            "ei_new",
+        ),
+        ("ei_new", "B"): _activity(
+            "B", "steel production", "GLO", "kilogram", "steel", [], "ei_new"
+        ),
+        ("ei_new", "E"): _activity(
+            "E",
+            "electricity production",
+            "RoW",
+            "kilowatt hour",
+            "electricity",
+            [],
+            "ei_new",
+        ),
+    }
+    bd.projects.set_current(old_project)
+    bd.Database("biosphere3").write(_biosphere(renamed_pm10=False))
+    bd.Database("ei_old").write(old)
+    bd.Database("fg").write(
+        {
+            ("fg", "X"): _activity(
+                "X",
+                "foreground production",
+                "CH",
+                "kilogram",
+                "foreground",
+                [
+                    {"input": ("ei_old", "g"), "amount": 1, "type": "technosphere"},
+                    {"input": ("ei_old", "b"), "amount": 2, "type": "technosphere"},
+                    {"input": ("biosphere3", "co2"), "amount": 3, "type": "biosphere"},
+                ],
+                "fg",
+            ),
+            ("fg", "Y"): _activity(
+                "Y",
+                "foreground use",
+                "CH",
+                "kilogram",
+                "foreground use",
+                [{"input": ("fg", "X"), "amount": 1, "type": "technosphere"}],
+                "fg",
+            ),
+        }
+    )
+    bd.projects.set_current(new_project)
+    bd.Database("biosphere3").write(_biosphere(renamed_pm10=True))
+    bd.Database("ei_new").write(new)
+    yield old_project, new_project
+    for project in (old_project, new_project):
+        bd.projects.delete_project(project, delete_dir=True)
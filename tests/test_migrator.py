@@ -0,0 +1,449 @@
+import bw2data as bd
+import pytest
+
+import migrator as migrator_module
+from migrator import ActivityProjectMigrator
+
+
+def _migrator(projects, **kwargs):
+    old_project, new_project = projects
+    return ActivityProjectMigrator(
+        "ei_old", old_project, "ei_new", new_project, **kwargs
+    )
+
+
+def _new_exchanges(projects, key):
+    bd.projects.set_current(projects[1])
+    return {
+        (exchange.input.key, exchange["type"])
+        for exchange in bd.get_activity(key).exchanges()
+    }
+
+
+def _add_xenon(projects):
+    bd.projects.set_current(projects[1])
+    bd.Database("biosphere3").new_activity(
+        code="xenon",
+        name="Xenon-135",
+        categories=("air",),
+        unit="kilogram",
+        type="emission",
+    ).save()
+
+
+def test_bulk_creation_and_matching(projects):
+    migrator = _migrator(projects)
+    results = migrator.migrate_many(
+        ["a", "b", "c"], create_if_not_found=True, return_key_only=True
+    )
+    assert results["a"] == (("ei_new", "A"), True)
+    assert results["b"] == (("ei_new", "B"), True)
+    assert results["c"][1] and results["c"][0] in migrator.created.values()
+    # c and d were created, with their exchanges
+    assert set(migrator.created) == {("ei_old", "c"), ("ei_old", "d")}
+    bd.projects.set_current(projects[1])
+    assert len(bd.Database("ei_new")) == 5
+    assert (("biosphere3", "water"), "biosphere") in _new_exchanges(
+        projects, results["c"][0]
+    )
+
+
+def test_cycle_is_created_once(projects):
+    migrator = _migrator(projects)
+    new_c, found = migrator.migrate_activity(
+        "c", create_if_not_found=True, return_key_only=True
+    )
+    assert found
+    new_d = migrator.created[("ei_old", "d")]
+    assert (new_d, "technosphere") in _new_exchanges(projects, new_c)
+    assert (new_c, "technosphere") in _new_exchanges(projects, new_d)
+    bd.projects.set_current(projects[1])
+    assert len(bd.Database("ei_new")) == 5
+
+
+def test_reserved_activities_extend_the_corpus(projects, monkeypatch):
+    builds = []
+    from_database = migrator_module._FuzzyCorpus.from_database.__func__
+
+    def counting(cls, database_name, biosphere):
+        builds.append(database_name)
+        return from_database(cls, database_name, biosphere)
+
+    monkeypatch.setattr(
+        migrator_module._FuzzyCorpus, "from_database", classmethod(counting)
+    )
+    migrator = _migrator(projects)
+    new_c, _ = migrator.migrate_activity(
+        "c", create_if_not_found=True, return_key_only=True
+    )
+    # c and d are both fuzzy matched and created, the corpus is only read once
+    assert builds == ["ei_new"]
+    # and it knows the created activities
+    matches = migrator.find_closest_matches(["unobtainium production CH unobtainium"])
+    assert matches[0][0] == (new_c, 100.0)
+    assert builds == ["ei_new"]
+
+
+def test_biosphere_synonym(projects):
+    bd.projects.set_current(projects[0])
+    bd.Database("biosphere3").new_activity(
+        code="dust",
+        name="Dust, coarse",
+        categories=("air",),
+        unit="kilogram",
+        type="emission",
+    ).save()
+    blasting = bd.Database("ei_old").new_activity(
+        code="k", name="sand blasting", location="CH", unit="kilogram"
+    )
+    blasting.save()
+    for flow in ("pm10", "dust"):
+        blasting.new_exchange(
+            input=("biosphere3", flow), amount=1, type="biosphere"
+        ).save()
+    # both flows were renamed in the new biosphere, the names are looked up in the synonym tables
+    migrator = _migrator(
+        projects, biosphere_synonyms={"Dust, coarse": "particulate matter, > 10 um"}
+    )
+    assert migrator.plan_migration(["k"])["biosphere"] == {
+        ("biosphere3", "pm10"): ("biosphere3", "pm10new"),
+        ("biosphere3", "dust"): ("biosphere3", "pm10new"),
+    }
+
+
+def test_location_fallback_is_opt_in(projects):
+    migrator = _migrator(projects)
+    migrator.migrate_activity("e")
+    assert migrator.cache.get(("ei_old", "e")).kind != "location"
+
+    migrator = _migrator(projects, location_fallback=True)
+    migrator.migrate_activity("e")
+    assert migrator.cache.get(("ei_old", "e")) == (("ei_new", "E"), "location", None)
+
+
+def test_rollback_and_delete_auto_generated(projects):
+    migrator = _migrator(projects)
+    migrator.migrate_many(["c"], create_if_not_found=True)
+    assert migrator.rollback() == 2
+    assert not migrator.created
+    bd.projects.set_current(projects[1])
+    assert len(bd.Database("ei_new")) == 3
+
+    # activities created by an earlier session are found by their attribute
+    _migrator(projects).migrate_activity("c", create_if_not_found=True)
+    assert _migrator(projects).delete_auto_generated() == 2
+    bd.projects.set_current(projects[1])
+    assert len(bd.Database("ei_new")) == 3
+
+
+def test_persistent_cache_reload(projects, tmp_path):
+    cache_path = str(tmp_path / "cache.sqlite")
+    table = tmp_path / "correspondence.csv"
+    table.write_text("old,new\nh,B\n")
+    migrator = _migrator(projects, cache_path=cache_path)
+    migrator.load_correspondence(str(table))
+    assert migrator.migrate_activity("h", return_key_only=True) == (
+        ("ei_new", "B"),
+        True,
+    )
+    migrator.save_cache()
+
+    # only the cache knows about the correspondence table
+    reloaded = _migrator(projects, cache_path=cache_path)
+    assert reloaded.migrate_activity("h", return_key_only=True) == (
+        ("ei_new", "B"),
+        True,
+    )
+
+    # writing to the new database outside of the migrator invalidates the cache
+    bd.projects.set_current(projects[1])
+    bd.Database("ei_new").new_activity(
+        code="other",
+        name="other",
+        unit="kilogram",
+        location="GLO",
+        **{"reference product": "other"},
+    ).save()
+    assert _migrator(projects, cache_path=cache_path).migrate_activity(
+        "h", return_key_only=True
+    ) == (("ei_old", "h"), False)
+
+
+def test_resume_after_failure(projects, tmp_path):
+    checkpoint_path = str(tmp_path / "checkpoint")
+    migrator = _migrator(projects, checkpoint_path=checkpoint_path)
+    migrator.migrate_activity("a")
+    # g can't be created until its xenon flow is in the new biosphere
+    with pytest.raises(ValueError):
+        migrator.migrate_many(["c", "g"], create_if_not_found=True)
+    _add_xenon(projects)
+
+    resumed = _migrator(projects, checkpoint_path=checkpoint_path)
+    created = resumed.resume()
+    assert set(created) == {("ei_old", "c"), ("ei_old", "d"), ("ei_old", "g")}
+    assert (created[("ei_old", "d")], "technosphere") in _new_exchanges(
+        projects, created[("ei_old", "c")]
+    )
+    assert (("biosphere3", "xenon"), "biosphere") in _new_exchanges(
+        projects, created[("ei_old", "g")]
+    )
+    bd.projects.set_current(projects[1])
+    assert len(bd.Database("ei_new")) == 6
+    # the results of the interrupted run are restored, nothing is matched or created twice
+    assert resumed.cache.get(("ei_old", "a")).new_key == ("ei_new", "A")
+    assert resumed.migrate_activity(
+        "c", create_if_not_found=True, return_key_only=True
+    ) == (created[("ei_old", "c")], True)
+
+    # the resumed run keeps adding to the same checkpoint
+    resumed.migrate_activity("b")
+    resumed.save_cache()
+    again = _migrator(projects, checkpoint_path=checkpoint_path)
+    assert again.resume() == {}
+    assert again.cache.get(("ei_old", "b")).new_key == ("ei_new", "B")
+    bd.projects.set_current(projects[1])
+    assert len(bd.Database("ei_new")) == 6
+
+
+def test_migrate_database_failure_writes_no_partial_activity(projects):
+    with pytest.raises(ValueError):
+        # g can't be created, its xenon flow isn't in the new biosphere
+        list(
+            _migrator(projects).migrate_database(
+                "fg", "fg new", create_if_not_found=True
+            )
+        )
+    bd.projects.set_current(projects[1])
+    assert len(bd.Database("fg new")) == 0
+
+    _add_xenon(projects)
+    migrator = _migrator(projects)
+    records = list(migrator.migrate_database("fg", "fg new", create_if_not_found=True))
+    assert records[-1]["exchanges"] == 6
+    assert _new_exchanges(projects, ("fg new", "X")) == {
+        (("fg new", "X"), "production"),
+        (migrator.created[("ei_old", "g")], "technosphere"),
+        (("ei_new", "B"), "technosphere"),
+        (("biosphere3", "co2"), "biosphere"),
+    }
+
+
+def test_migrate_database_copies_incomplete_activities_again(projects):
+    _add_xenon(projects)
+    # a copy of X left without its exchanges, e.g. by an interrupted run
+    bd.Database("fg new").write(
+        {
+            ("fg new", "X"): {
+                "name": "foreground production",
+                "location": "CH",
+                "unit": "kilogram",
+                "exchanges": [
+                    {"input": ("fg new", "X"), "amount": 1, "type": "production"}
+                ],
+            }
+        }
+    )
+    records = list(
+        _migrator(projects).migrate_database("fg", "fg new", create_if_not_found=True)
+    )
+    assert records[-1]["exchanges"] == 6
+    assert len(_new_exchanges(projects, ("fg new", "X"))) == 4
+    bd.projects.set_current(projects[1])
+    assert len(bd.Database("fg new")) == 2
+
+    # complete copies are skipped
+    records = list(_migrator(projects).migrate_database("fg", "fg new"))
+    assert records[-1]["exchanges"] == 0
+
+
+def test_matches_to_unwritten_activities_are_not_persisted(projects, tmp_path):
+    cache_path = str(tmp_path / "cache.sqlite")
+    migrator = _migrator(projects, cache_path=cache_path)
+    # the xenon flow isn't in the new biosphere, so g is reserved but never written
+    with pytest.raises(ValueError):
+        migrator.migrate_activity("g", create_if_not_found=True)
+    # h has the same details, it resolves to the reserved key of g, which has to be written first
+    with pytest.raises(ValueError):
+        migrator.migrate_activity("h")
+    migrator.save_cache()
+
+    plan = _migrator(projects, cache_path=cache_path).plan_migration(["g", "h"])
+    assert plan["activities"]["g"]["kind"] == "create"
+    assert plan["activities"]["h"]["kind"] == "create"
+
+
+def test_cached_results_follow_the_fuzzy_settings(projects, tmp_path):
+    cache_path = str(tmp_path / "cache.sqlite")
+    not_found, found = (("ei_old", "e"), False), (("ei_new", "E"), True)
+    migrator = _migrator(projects, cache_path=cache_path)
+    assert migrator.migrate_activity("e", fuzzy_match=False) == not_found
+    assert migrator.migrate_activity("e", fuzzy_match_score=50) == found
+    assert migrator.migrate_activity("e", fuzzy_match=False) == not_found
+    assert migrator.migrate_activity("e", fuzzy_match_score=95) == not_found
+    assert migrator.migrate_many(["e"]) == {"e": found}
+    migrator.save_cache()
+
+    reloaded = _migrator(projects, cache_path=cache_path)
+    assert reloaded.migrate_many(["e"], fuzzy_match=False) == {"e": not_found}
+    assert reloaded.migrate_activity("e") == found
+
+
+@pytest.mark.parametrize("use_rapidfuzz", [True, False])
+def test_fuzzy_scores_match_token_sort_ratio(projects, monkeypatch, use_rapidfuzz):
+    reference = pytest.importorskip("rapidfuzz")
+    if not use_rapidfuzz:
+        # the pure Python fallback has to give the same scores
+        monkeypatch.setattr(migrator_module, "rf_process", None)
+    queries = [
+        "iron (III) chloride production RER iron (III) chloride",
+        "steel production, low alloyed GLO steel",
+        "Electricity production GLO electricity",
+    ]
+    bd.projects.set_current(projects[1])
+    choices = {
+        activity.key: f"{activity['name']} {activity['location']} {activity['reference product']}"
+        for activity in bd.Database("ei_new")
+    }
+    results = _migrator(projects).find_closest_matches(
+        queries, score_cutoff=0, limit=len(choices)
+    )
+    for query, matches in zip(queries, results):
+        assert dict(matches) == {
+            key: round(
+                reference.fuzz.token_sort_ratio(
+                    query, choice, processor=reference.utils.default_process
+                )
+            )
+            for key, choice in choices.items()
+        }
+
+
+def test_prefilter_keeps_the_best_matches(projects):
+    materials = ["steel", "copper", "aluminium", "glass", "cement", "paper", "nylon"]
+    processes = ["production", "treatment", "market for", "recycling"]
+    locations = ["GLO", "RER", "CH", "DE", "CN", "US"]
+    variants = ["", ", primary", ", secondary", ", low alloyed", ", in pellets"]
+    activities = {}
+    for material in materials:
+        for process in processes:
+            for location in locations:
+                for variant in variants:
+                    code = f"{material} {process} {location}{variant}"
+                    activities[("synthetic", code)] = {
+                        "name": f"{material} {process}{variant}",
+                        "location": location,
+                        "unit": "kilogram",
+                        "reference product": material,
+                    }
+    bd.projects.set_current(projects[1])
+    bd.Database("synthetic").write(activities)
+    queries = [
+        "steal production, primary RER steel",
+        "copper treatment, secondry CH copper",
+        "market for alumnium GLO aluminium",
+        "glass recycling DE glas",
+        "nylon production, in pellet CN nylon",
+    ]
+    # every score of the full scan, the database comes back in random order so ties may swap
+    full = _migrator(projects, fuzzy_prefilter_limit=None).find_closest_matches(
+        queries, database_name="synthetic", score_cutoff=70, limit=len(activities)
+    )
+    prefiltered = _migrator(projects, fuzzy_prefilter_limit=30).find_closest_matches(
+        queries, database_name="synthetic", score_cutoff=70
+    )
+    for matches, every in zip(prefiltered, full):
+        scores = dict(every)
+        assert len(matches) == 5
+        assert [score for _, score in matches] == [score for _, score in every[:5]]
+        assert all(scores[key] == score for key, score in matches)
+
+
+def test_plan_migration_writes_nothing(projects):
+    plan = _migrator(projects).plan_migration(["a", "c", "g"])
+    assert plan["activities"]["a"] == {
+        "kind": "normalized",
+        "key": ("ei_new", "A"),
+        "score": None,
+    }
+    assert plan["activities"]["c"]["kind"] == "create"
+    assert set(plan["create"]) == {("ei_old", "c"), ("ei_old", "d"), ("ei_old", "g")}
+    assert [set(cycle) for cycle in plan["cycles"]] == [
+        {("ei_old", "c"), ("ei_old", "d")}
+    ]
+    # the xenon flow is missing in the new biosphere, creating g would fail
+    assert plan["biosphere"] == {
+        ("biosphere3", "water"): ("biosphere3", "water"),
+        ("biosphere3", "xenon"): None,
+    }
+    bd.projects.set_current(projects[1])
+    assert len(bd.Database("ei_new")) == 3
+
+
+def test_migrate_database_streams_progress(projects):
+    migrator = _migrator(projects)
+    with pytest.raises(ValueError):
+        next(migrator.migrate_database("fg", "ei_new"))
+
+    # one activity per chunk, g has no match and isn't created so the exchange to it is left out
+    records = list(migrator.migrate_database("fg", "fg new", chunk_size=1))
+    assert [(record["done"], record["total"]) for record in records] == [(1, 2), (2, 2)]
+    assert sum(record["exchanges"] for record in records) == 5
+    assert sum(record["created"] for record in records) == 0
+    assert [unlinked for record in records for unlinked in record["unlinked"]] == [
+        ("X", ("ei_old", "g"))
+    ]
+    # exchanges between the migrated activities stay in the target database
+    assert (("fg new", "X"), "technosphere") in _new_exchanges(
+        projects, ("fg new", "Y")
+    )
+    assert (("ei_new", "B"), "technosphere") in _new_exchanges(
+        projects, ("fg new", "X")
+    )
+
+
+def test_load_correspondence(projects, tmp_path):
+    path = tmp_path / "correspondence.csv"
+    path.write_text("old,new\nh,B\nb,B\nc,A\nc,E\ne,missing\n")
+    migrator = _migrator(projects)
+    assert migrator.load_correspondence(str(path)) == {
+        "entries": 2,
+        "splits": {"c": ["A", "E"]},
+        "merges": {"B": ["h", "b"]},
+        "missing": ["missing"],
+    }
+    activities = migrator.plan_migration(["h", "c", "e"])["activities"]
+    assert activities["h"] == {
+        "kind": "correspondence",
+        "key": ("ei_new", "B"),
+        "score": None,
+    }
+    # splits and rows with missing codes are left to the other matching steps
+    assert activities["c"]["kind"] == "create"
+    assert activities["e"]["kind"] == "fuzzy"
+
+
+def test_shared_cas_numbers_are_matched_by_name(projects):
+    non_fossil = {
+        "name": "Carbon dioxide, non-fossil",
+        "categories": ("air",),
+        "unit": "kilogram",
+        "type": "emission",
+        "CAS number": "000124-38-9",
+    }
+    bd.projects.set_current(projects[0])
+    bd.Database("biosphere3").new_activity(code="co2nf", **non_fossil).save()
+    burning = bd.Database("ei_old").new_activity(
+        code="k", name="wood burning", location="CH", unit="kilogram"
+    )
+    burning.save()
+    burning.new_exchange(
+        input=("biosphere3", "co2nf"), amount=1, type="biosphere"
+    ).save()
+    # fossil and non-fossil carbon dioxide share their CAS number in the new biosphere
+    bd.projects.set_current(projects[1])
+    bd.Database("biosphere3").new_activity(code="co2 non-fossil", **non_fossil).save()
+
+    plan = _migrator(projects).plan_migration(["k"])
+    assert plan["biosphere"] == {
+        ("biosphere3", "co2nf"): ("biosphere3", "co2 non-fossil")
+    }